@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+#
+#   Encode: Stream rendered frames into a video while they render.
+#
+#   This reads the render.json manifest written by the exporter, and
+#   feeds each target's frames in order to an ffmpeg process through a
+#   pipe, writing one video per target next to its frames. Frames are
+#   either rendered here by the local runner, or, with --watch, waited
+#   for as the render script or other computers write them. A watched
+#   frame which isn't written is reported after a minute, and skipped
+#   after --timeout seconds if given.
+#
+#   Frames which are done out of order wait in a bounded buffer. When
+#   rendering here, frames are dispatched in order, and no further than
+#   the buffer size ahead of the first frame not done yet. With
+#   --delete, frames are deleted once encoded, with the histograms of
+#   split frames, so that the disk only holds about as many frames as
+#   the buffer.
+#
+#   If ffmpeg can't be run or exits early, the video is reported as
+#   failed, its remaining frames are kept, and other videos go on.
+#
+#   usage: encode.py [-j WORKERS] [--watch [--timeout SECONDS]] [--delete]
+#                    render.json
+#
+######################################################################
+#
+#   This file is part of HQZ, the batch renderer for Zen Photon Garden.
+#
+
+import argparse
+import collections
+import os
+import re
+import subprocess
+import sys
+import time
+
+import local_runner
+
+
+# Images named <export filepath>.<frame>.png
+FRAME_IMAGE = re.compile(r'^(.*)\.(\d+)\.png$')
+
+# Last chunk of a complete PNG file
+PNG_END = b'\x00\x00\x00\x00IEND\xaeB`\x82'
+
+
+class Encoder:
+    '''Feed PNG frames to an ffmpeg process in order, as they are done.
+
+    If ffmpeg fails, error holds the reason, and the next frames are
+    skipped.'''
+
+    def __init__(self, images, output, framerate=30, delete=False,
+                 ffmpeg='ffmpeg'):
+        self.images = images
+        self.output = output
+        self.delete = delete
+        self.encoded = 0
+        self.skipped = 0
+        self.next = 0
+        # Images done out of order, and whether they succeeded
+        self.buffer = {}
+        self.error = None
+
+        # Same settings as cluster-encode
+        try:
+            self.process = subprocess.Popen(
+                [ffmpeg, '-y', '-loglevel', 'error',
+                 '-f', 'image2pipe', '-c:v', 'png',
+                 '-framerate', str(framerate), '-i', '-',
+                 '-c:v', 'libx264', '-preset', 'slow', '-crf', '18',
+                 '-pix_fmt', 'yuv420p', output],
+                stdin=subprocess.PIPE)
+        except OSError as e:
+            self.process = None
+            self.fail("can't run %s: %s" % (ffmpeg, e))
+
+    def fail(self, error):
+        '''Stop encoding the video, reporting why.'''
+        self.error = error
+        sys.stderr.write('Encoding %s failed: %s\n' % (self.output, error))
+
+    def put(self, image, ok=True):
+        '''Add a done image, and encode all images now in order. Failed
+        images are skipped.'''
+        self.buffer[image] = ok
+        while (self.next < len(self.images)
+               and self.images[self.next] in self.buffer):
+            image = self.images[self.next]
+            if self.buffer.pop(image) and self.error is None:
+                self.encode(image)
+            else:
+                self.skipped += 1
+            self.next += 1
+
+    def encode(self, image):
+        '''Pipe an image to ffmpeg.'''
+        try:
+            with open(image, 'rb') as f:
+                data = f.read()
+        except OSError as e:
+            sys.stderr.write('Skipping %s: %s\n' % (image, e))
+            self.skipped += 1
+            return
+        try:
+            self.process.stdin.write(data)
+        except BrokenPipeError:
+            self.fail('ffmpeg exited early')
+            self.skipped += 1
+            return
+        self.encoded += 1
+        if self.delete:
+            os.remove(image)
+
+    def done(self):
+        return self.next == len(self.images)
+
+    def finish(self):
+        '''Wait for the end of the video. Returns why it failed, or
+        None.'''
+        if self.process is None:
+            return self.error
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            # Buffered frames couldn't be written
+            self.error = self.error or 'ffmpeg exited early'
+        returncode = self.process.wait()
+        if returncode:
+            return 'ffmpeg exited with code %d' % returncode
+        return self.error
+
+
+def frame_images(manifest):
+    '''Get the final images of the manifest, by video, in frame order.'''
+    videos = collections.defaultdict(list)
+    for frame in manifest['frames']:
+        image = frame.get('merge', frame['image'])
+        match = FRAME_IMAGE.match(image)
+        if match and image not in videos[match.group(1)]:
+            videos[match.group(1)].append(image)
+    for images in videos.values():
+        images.sort(key=lambda image: int(FRAME_IMAGE.match(image).group(2)))
+    return videos
+
+
+def is_complete(path):
+    '''Check that a PNG file exists and was completely written.'''
+    try:
+        with open(path, 'rb') as f:
+            f.seek(-len(PNG_END), os.SEEK_END)
+            return f.read() == PNG_END
+    except OSError:
+        return False
+
+
+def watch(encoders, interval=1.0, timeout=None, notice=60.0):
+    '''Encode frames as they appear, until all are encoded.
+
+    A frame not written after notice seconds is reported once. With a
+    timeout, a frame not written after timeout seconds is skipped, so
+    that a frame which failed to render doesn't hold the video forever.'''
+    # Next image of each encoder, when it was first waited for, and
+    # whether the wait was reported
+    waiting = {}
+    while not all(encoder.done() for encoder in encoders):
+        now = time.time()
+        for encoder in encoders:
+            # Only the next few frames are checked, up to the first one
+            # not done yet
+            while not encoder.done():
+                image = encoder.images[encoder.next]
+                if is_complete(image):
+                    encoder.put(image)
+                    continue
+                if waiting.get(encoder, (None,))[0] != image:
+                    waiting[encoder] = (image, now, False)
+                image, since, noticed = waiting[encoder]
+                if timeout is not None and now - since >= timeout:
+                    sys.stderr.write('Skipping %s: not written after %d s\n'
+                                     % (image, timeout))
+                    encoder.put(image, False)
+                    continue
+                if not noticed and now - since >= notice:
+                    print('Waiting for %s' % image)
+                    waiting[encoder] = (image, since, True)
+                break
+        time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Encode exported frames into videos while they render.')
+    parser.add_argument('manifest', help='render.json written by the exporter')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(),
+                        help='number of hqz processes to run at once')
+    parser.add_argument('--watch', action='store_true',
+                        help="don't render, wait for frames to be written")
+    parser.add_argument('--timeout', type=float,
+                        help='with --watch, skip frames not written after '
+                             'this many seconds')
+    parser.add_argument('--delete', action='store_true',
+                        help='delete frames once encoded')
+    parser.add_argument('--buffer', type=int, default=16,
+                        help='maximum number of frames rendered ahead')
+    parser.add_argument('--framerate', type=float, default=30)
+    parser.add_argument('--ffmpeg', default='ffmpeg',
+                        help='path to the ffmpeg executable')
+    args = parser.parse_args()
+
+    manifest = local_runner.load_manifest(args.manifest)
+    videos = frame_images(manifest)
+    if not videos:
+        print('No frames to encode')
+        return 0
+
+    encoders = {}
+    for base, images in sorted(videos.items()):
+        encoders[base] = Encoder(images, base + '.mp4', args.framerate,
+                                 args.delete, args.ffmpeg)
+        if encoders[base].error is None:
+            print('Encoding %d frames to %s' % (len(images), base + '.mp4'))
+    by_image = {image: encoder for encoder in encoders.values()
+                for image in encoder.images}
+
+    # Histograms of split frames, deleted with their merged frame
+    histograms = collections.defaultdict(list)
+    for frame in manifest['frames']:
+        if 'merge' in frame:
+            histograms[frame['merge']].append(frame['image'])
+
+    failures = 0
+    if args.watch:
+        try:
+            watch(list(encoders.values()), timeout=args.timeout)
+        except KeyboardInterrupt:
+            # Keep the frames encoded so far
+            print('Interrupted')
+    else:
+        def on_frame(frame, returncode):
+            encoder = by_image.get(frame['image'])
+            if encoder is not None:
+                encoder.put(frame['image'], not returncode)
+                if args.delete:
+                    for histogram in histograms[frame['image']]:
+                        if os.path.exists(histogram):
+                            os.remove(histogram)
+                print('%s %s, %d frames buffered'
+                      % (frame['image'], 'failed' if returncode else 'done',
+                         len(encoder.buffer)))
+
+        failures = local_runner.run(manifest, args.workers, on_frame,
+                                    window=args.buffer)
+
+    for encoder in encoders.values():
+        error = encoder.finish()
+        if error:
+            failures += 1
+            print('Failed to encode %s: %s' % (encoder.output, error))
+        else:
+            print('Encoded %s: %d frames, %d skipped'
+                  % (encoder.output, encoder.encoded, encoder.skipped))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -34,6 +34,7 @@
 #       [%i] % etc.
 
 import maya.cmds as cmds
+import maya.api.OpenMaya as om
 from math import pi, floor, fabs, atan2
 import os.path
 
@@ -72,29 +73,34 @@ def HSV2wavelength(color):
         wavelength = 0
     return wavelength
     
-def get_loc(object):
-    loc = cmds.xform(object, worldSpace = True, translation=True, query=True)
-    x, y = loc[0]*resolution_x, loc[1]*resolution_x
+def get_loc(object, frame):
+    matrix = cmds.getAttr(object + '.worldMatrix', time=frame)
+    x, y = matrix[12]*resolution_x, matrix[13]*resolution_x
     return x,y
 
-def get_rot(object):
-#    rot = cmds.xform(object, absolute=True, rotation=True, query=True)
-    selection = cmds.ls(sl=True)
-    loc = cmds.spaceLocator(position=(0,0,0))
-    orient_cons = cmds.orientConstraint(object,loc)
-    cmds.delete(orient_cons)
-    cmds.move(0,0,-1, loc, relative = True, objectSpace = True)
-    vec = []
-    vec.append(cmds.xform(loc, absolute=True, translation=True, query=True)[0])
-    vec.append(cmds.xform(loc, absolute=True, translation=True, query=True)[1])
+def get_rot(object, frame):
+    #-Z axis of the object at frame, read from its world matrix to avoid changing current time
+    matrix = cmds.getAttr(object + '.worldMatrix', time=frame)
+    vec = [-matrix[8], -matrix[9]]
     rot = vector2rotation(vec)
-    cmds.delete(loc)
-    try:
-        cmds.select(selection, replace=True)
-    except:
-        pass
     return -rot
 
+def get_context(frame):
+    return om.MDGContext(om.MTime(frame, om.MTime.uiUnit()))
+
+def get_mesh_frames(shape, frame_range):
+    #evaluate the world mesh at each frame through a DG context, without changing current time
+    #yields edges, world space points and vertex normals for each frame
+    selection_list = om.MSelectionList()
+    selection_list.add(shape)
+    plug = om.MFnDependencyNode(selection_list.getDependNode(0)).findPlug('worldMesh', False).elementByLogicalIndex(0)
+    for frame in frame_range:
+        mesh = om.MFnMesh(plug.asMObject(get_context(frame)))
+        edges = [mesh.getEdgeVertices(e) for e in range(mesh.numEdges)]
+        points = mesh.getPoints(om.MSpace.kObject) #worldMesh data is already in world space
+        normals = mesh.getVertexNormals(False, om.MSpace.kObject)
+        yield edges, points, normals
+
 
 def vector2rotation(vector2d):
     null_vec = [1,0]
@@ -186,27 +192,97 @@ def prepare():
         pass
         
         
+def get_light_code(obj, shape, frame):
+    wav = HSV2wavelength([cmds.getAttr(shape[0]+'.colorR', time=frame), cmds.getAttr(shape[0]+'.colorG', time=frame), cmds.getAttr(shape[0]+'.colorB', time=frame)])
+    use_spectral = cmds.getAttr(shape[0]+'.hqzSpectralLight', time=frame)
+    spectral_start = cmds.getAttr(shape[0]+'.hqzSpectralStart', time=frame)
+    spectral_end = cmds.getAttr(shape[0]+'.hqzSpectralEnd', time=frame)
+    x, y = get_loc(obj, frame)
+    y = resolution_y-y
+    rot = get_rot(obj, frame)
+
+    light_code = '        [ '
+    light_code += str(cmds.getAttr(shape[0]+'.intensity', time=frame)) + ', '     #LIGHT POWER
+    light_code += str(x) + ', '                                                   #XPOS
+    light_code += str(y)                                                          #YPOS
+    light_code += ', [0, 360], ['                                                 #POLAR ANGLE
+    light_code += str(cmds.getAttr(shape[0]+'.hqzLightStart', time=frame)) + ', ' #POLAR DISTANCE MIN
+    light_code += str(cmds.getAttr(shape[0]+'.hqzLightEnd', time=frame)) + '], [' #POLAR DISTANCE MIN
+
+    if cmds.objectType(shape, isType='spotLight'):
+        cone_angle = cmds.getAttr(shape[0]+'.coneAngle', time=frame)
+        light_code += str(-rot-cone_angle*0.5) + ', '                             #ANGLE
+        light_code += str(-rot+cone_angle*0.5) + '], '
+    else:
+        light_code += '0, 360], '
+
+    if use_spectral:
+        light_code += '[' + str(spectral_start) + ', ' + str(spectral_end) + '] ],\n'                                         #WAVELENGTH
+    else:
+        light_code += str(int(wav))  +' ],\n'                                     #WAVELENGTH
+    return light_code
+
+
+def get_edge_list(obj, shape, frame_range):
+    #### GET MAYA EDGE LIST FOR ALL FRAMES IN ONE PASS
+    edge_lists = {}
+    for frame, (edges, points, normals) in zip(frame_range, get_mesh_frames(shape[0], frame_range)):
+        edge_list = edge_lists[frame] = []
+        if not cmds.getAttr(obj + '.v', time=frame):
+            continue
+        material = str(cmds.getAttr(shape[0]+'.hqzMaterial', time=frame))
+        for edge in edges:
+            edgev = []
+            edgev.append(material)
+            for v_ix in range(2):
+                point = points[edge[v_ix]]
+                edgev.append([point.x, point.y, point.z])
+            if export_normals:
+                #normals are in world space, so they already include object rotation
+                for v_ix in range(2):
+                    normal = normals[edge[v_ix]]
+                    edgev.append(vector2rotation([normal.x, normal.y]))
+
+            if check_Z:
+                if fabs(edgev[1][2]) < 0.0001 and fabs(edgev[2][2]) < 0.0001:
+                    edge_list.append(edgev)
+            else:
+                edge_list.append(edgev)
+    return edge_lists
+
+
 ###START WRITING
 def export():
     get_ui_values()
     selection = cmds.ls(sl=True)
-    
+
     if export_animation:
         frame_range = range(start_frame, end_frame+1)
     else:
         frame_range = cmds.currentTime(query=True),
-    
+
+    #### EVALUATE ALL FRAMES OF EACH OBJECT, WITHOUT CHANGING CURRENT TIME
+    light_codes = dict((frame, '') for frame in frame_range)
+    edge_lists = dict((frame, []) for frame in frame_range)
+    for obj in selection:
+        shape = cmds.listRelatives(obj, shapes=True)
+        if cmds.objectType(shape, isType='pointLight') or cmds.objectType(shape, isType='spotLight'):
+            for frame in frame_range:
+                if cmds.getAttr(obj + '.visibility', time=frame):
+                    light_codes[frame] += get_light_code(obj, shape, frame)
+        if cmds.objectType(shape, isType='mesh'):
+            for frame, edge_list in get_edge_list(obj, shape, frame_range).items():
+                edge_lists[frame] += edge_list
+
     for frame in frame_range:
-        
+
         #####FRAME SETTINGS OVERRIDE GENERAL SETTINGS
         seed = frame
-        
-        
-        
-        cmds.currentTime(frame,edit=True)
-        
+
+
+
         scene_code = ''
-        
+
         scene_code += '{\n'#begin
         scene_code += '    "resolution": [' + str(resolution_x) + ', ' + str(resolution_y) + '],\n'
         scene_code += '    "viewport":  [0, 0, ' + str(resolution_x) + ', ' + str(resolution_y) + '],\n'
@@ -216,98 +292,22 @@ def export():
         if time != 0:
             scene_code += '    "timelimit": ' + str(time) + ',\n'
         scene_code += '    "seed": ' + str(int(seed)) + ',\n'
-        
-        
+
+
         #### LIGHTS
-        
+
         scene_code += '    "lights": [\n'
-        
-        for obj in cmds.ls(sl=True):
-            shape = cmds.listRelatives(obj, shapes=True)
-            if (cmds.objectType(shape, isType='pointLight') or cmds.objectType(shape, isType='spotLight')) and cmds.getAttr(obj + '.visibility'):
-                wav = HSV2wavelength([cmds.getAttr(shape[0]+'.colorR'), cmds.getAttr(shape[0]+'.colorG'), cmds.getAttr(shape[0]+'.colorB')])
-                use_spectral = cmds.getAttr(shape[0]+'.hqzSpectralLight')
-                spectral_start = cmds.getAttr(shape[0]+'.hqzSpectralStart')
-                spectral_end = cmds.getAttr(shape[0]+'.hqzSpectralEnd')
-                x, y = get_loc(obj)
-                y = resolution_y-y
-                rot = get_rot(obj)
-                
-                scene_code += '        [ '
-                scene_code += str(cmds.getAttr(shape[0]+'.intensity')) + ', '                 #LIGHT POWER
-                scene_code += str(x) + ', '                                                   #XPOS
-                scene_code += str(y)                                                          #YPOS
-                scene_code += ', [0, 360], ['                                                 #POLAR ANGLE
-                scene_code += str(cmds.getAttr(shape[0]+'.hqzLightStart')) + ', '             #POLAR DISTANCE MIN
-                scene_code += str(cmds.getAttr(shape[0]+'.hqzLightEnd')) + '], ['             #POLAR DISTANCE MIN
-                #scene_code += '0' + ', ' #POLAR DISTANCE MIN
-                #scene_code += '0' + '], [' #POLAR DISTANCE MAX
-                
-                if cmds.objectType(shape, isType='spotLight'):
-                    scene_code += str(-rot-cmds.getAttr(shape[0]+'.coneAngle')*0.5) + ', '               #ANGLE
-                    scene_code += str(-rot+cmds.getAttr(shape[0]+'.coneAngle')*0.5) + '], '
-                else:
-                    scene_code += '0, 360], '
-                    
-                if use_spectral:
-                    scene_code += '[' + str(spectral_start) + ', ' + str(spectral_end) + '] ],\n'                                         #WAVELENGTH
-                else:
-                    scene_code += str(int(wav))  +' ],\n'                                         #WAVELENGTH
-                
+        scene_code += light_codes[frame]
+
         scene_code = scene_code[:-2]#remove last comma
         scene_code += '\n    ],\n'
-        
-        
-        
+
+
+
         scene_code += '    "objects": [\n'
-        
-        
-        #### GET MAYA EDGE LIST
-        edge_list = []
-        for obj in cmds.ls(sl=True):
-            shape = cmds.listRelatives(obj, shapes=True)
-            if cmds.objectType(shape, isType='mesh') and (cmds.getAttr(obj + '.v')):                
-                cmds.select(obj)
-                edge_info = cmds.polyInfo(edgeToVertex=True)#get vertices connected to edge
-                #print(edge_info)
-                edges=[]
-                for edge in edge_info:
-                    #print(edge)
-                    edge = edge.split(':')[1]
-                    edge = [int(edge[:7]),int(edge[8:15])]
-                    #print(edge.split(' '))#get vertices connected to edge
-                    edges.append(edge)
-                #print(edges)
-                
-                
-                for edge in edges:
-                    edgev = []
-        #                vertices = list(edge.vertices)
-                    #material = obj.split('_')[1]
-                    material = str(cmds.getAttr(shape[0]+'.hqzMaterial'))
-                    edgev.append(material)
-                    edgev.append(cmds.xform(obj+'.vtx[%i]' % edge[0], translation=True, absolute=True, worldSpace=True, query=True))
-                    edgev.append(cmds.xform(obj+'.vtx[%i]' % edge[1], translation=True, absolute=True, worldSpace=True, query=True))
-                    if export_normals:
-                        #print(vertices[0])
-                        for v_ix in range(2):
-                            cmds.select(obj+'.vtx[%i]' % edge[v_ix])
-                            vectors = cmds.polyNormalPerVertex(query=True, xyz=True)
-                            edgev.append(cmds.xform(obj, rotation=True, query=True)[2] + vector2rotation([vectors[0],vectors[1]]))
-                        #edgev.append((obj.rotation_euler[2] * 180/pi) + vector2rotation(obj.data.vertices[vertices[0]].normal))
-                        #edgev.append((obj.rotation_euler[2] * 180/pi) + vector2rotation(obj.data.vertices[vertices[1]].normal))
-                    
-                    #print(edgev)
-                    if check_Z:
-                        #print(fabs(cmds.xform(obj+'.vtx[%i]' % edge[0], translation=True, absolute=True, worldSpace=True, query = True)[2]))
-                        if fabs(cmds.xform(obj+'.vtx[%i]' % edge[0], translation=True, absolute=True, worldSpace=True, query=True)[2]) < 0.0001 \
-                        and fabs( cmds.xform(obj+'.vtx[%i]' % edge[1], translation=True, absolute=True, worldSpace=True, query=True)[2]) < 0.0001:
-                            edge_list.append(edgev)
-                    else:
-                        edge_list.append(edgev)
-                    #print(edgev)
-        #print(edge_list)
-        
+
+        edge_list = edge_lists[frame]
+
         ####OBJECTS
         for edge in edge_list:
             #print(edge)
@@ -21,10 +21,20 @@ bl_info = {
 
 import bpy
 from mathutils import Vector
-from math import degrees
+from math import degrees, log2
 from bpy_extras.object_utils import world_to_camera_view
 import os
+import hashlib
 import json
+import numpy as np
+import queue
+import subprocess
+import threading
+import time
+import traceback
+from collections import namedtuple
+
+from . import adaptive, cache, culling, preview
 
 
 # UTILITY FUNCTIONS
@@ -44,78 +54,101 @@ def color_to_wavelength(color):
             return [w_min, w_max]
 
 
-def get_normal_from_points(sc, obj, p1, p2):
+# Camera and resolution to export the scene for, and where to write it
+Target = namedtuple('Target', ('camera', 'resolution_percentage',
+                               'export_filepath'))
+
+
+def get_target_size(sc, target):
+    '''Get the image size in pixels for the target in argument.'''
+    rp = target.resolution_percentage / 100.0
+    return sc.render.resolution_x * rp, sc.render.resolution_y * rp
+
+
+def get_normal_from_points(sc, target, p1, p2):
     '''Given two points, return their 2d normal vector in camera view.'''
-    cam = sc.camera
-    rp = sc.render.resolution_percentage / 100.0
+    cam = target.camera
+    width, height = get_target_size(sc, target)
     p1_cam = world_to_camera_view(sc, cam, p1)
     p2_cam = world_to_camera_view(sc, cam, p2)
 
     normal = (p2_cam - p1_cam).xy
-    normal.x *= sc.render.resolution_x * rp
-    normal.y *= sc.render.resolution_y * rp
+    normal.x *= width
+    normal.y *= height
     normal = normal.normalized()
     return normal
 
 
-def get_object_rot(scene, object):
+def get_object_rot(scene, target, object):
     '''Get 2d rotation for object in argument.'''
     p1 = object.matrix_world.to_translation()
     p2 = object.matrix_world.inverted()[2].xyz
     p2 *= -1
-    normal = get_normal_from_points(scene, object, p1, p2)
+    normal = get_normal_from_points(scene, target, p1, p2)
     rot = degrees(Vector((1.0, 0.0)).angle_signed(normal))
     return rot
 
 
-def write_render_script(export_dir, hqz_params, frame_range):
+def get_render_commands(hqz_params, image, python):
+    '''Get the commands rendering the image in argument, merging its
+    sub-jobs if frames are split.'''
+    # Blender's // paths mean nothing to the shell
+    hqz_bin_path = bpy.path.abspath(hqz_params.hqz_bin_path)
+    hqz = '"{}"'.format(hqz_bin_path)
+    if hqz_params.sub_jobs <= 1:
+        return ['{} "{}.json" "{}.png"'.format(hqz, image, image)]
+
+    parts = ['{}.part{}'.format(image, part)
+             for part in range(hqz_params.sub_jobs)]
+    commands = ['{} --histogram "{}.json" "{}.hist"'.format(hqz, part, part)
+                for part in parts]
+    merge = os.path.join(os.path.dirname(hqz_bin_path), 'merge.py')
+    commands.append('{} "{}" "{}.json" "{}.png" {}'.format(
+        python, merge, parts[0], image,
+        ' '.join('"{}.hist"'.format(part) for part in parts)))
+    return commands
+
+
+def write_render_script(export_dir, hqz_params, frame_range,
+                        export_filepaths):
     """Write script for rendering multiple images"""
     platform = os.sys.platform
     render_script_path = os.path.join(export_dir, 'render')
+    images = [export_filepath + '.' + str(frame).zfill(4)
+              for frame in frame_range
+              for export_filepath in export_filepaths]
     if 'win' in platform:
         render_script_path += '.bat'
         script = 'ECHO off\n\n'
-        for frame in frame_range:
+        for image in images:
             if hqz_params.ignore:
                 script += (
                     'if exist "{image}.png" (\n'
                     '    ECHO "Ignoring existing file"\n'
                     ') else (\n'
-                    ).format(
-                        image=(hqz_params.export_filepath
-                               + '.' + str(frame).zfill(4)
-                               )
-                )
-            script += (
-                '    ECHO "Rendering image {image}..."\n'
-                '    "{hqz_bin_path}" "{image}.json" "{image}.png"\n'
-            ).format(image=(hqz_params.export_filepath
-                            + '.' + str(frame).zfill(4)),
-                     hqz_bin_path=hqz_params.hqz_bin_path)
+                    ).format(image=image)
+            script += '    ECHO "Rendering image {image}..."\n'.format(
+                image=image)
+            for command in get_render_commands(hqz_params, image, 'python'):
+                script += '    ' + command + '\n'
             if hqz_params.ignore:
                 script += ')'
             script += '\n'
     else:
         render_script_path += '.sh'
         script = '#!/bin/bash\n\n'
-        for frame in frame_range:
+        for image in images:
             if hqz_params.ignore:
                 script += (
                     'if [ -f "{image}.png" ]\n'
                     'then\n'
                     '    echo "Ignoring existing file"\n'
                     'else\n'
-                    ).format(
-                        image=(hqz_params.export_filepath
-                               + '.' + str(frame).zfill(4)
-                               )
-                        )
-            script += (
-                '    echo "Rendering image {image}..."\n'
-                '    "{hqz_bin_path}" "{image}.json" "{image}.png"\n'
-            ).format(image=(hqz_params.export_filepath
-                            + '.' + str(frame).zfill(4)),
-                     hqz_bin_path=hqz_params.hqz_bin_path)
+                    ).format(image=image)
+            script += '    echo "Rendering image {image}..."\n'.format(
+                image=image)
+            for command in get_render_commands(hqz_params, image, 'python3'):
+                script += '    ' + command + '\n'
             if hqz_params.ignore:
                 script += 'fi'
             script += '\n'
@@ -125,214 +158,1256 @@ def write_render_script(export_dir, hqz_params, frame_range):
     file.close()
 
 
-def export(self, context):
-    '''Create export data and write to file.'''
+def estimate_cost(export_data):
+    '''Estimate the relative render time of an exported frame.
+
+    Each ray chooses a light, then traverses the segments' quadtree once
+    per bounce. The number of bounces grows with the probability of rays
+    to be scattered rather than absorbed, averaged over all segments.'''
+    objects = export_data['objects']
+    scattering = [min(sum(weight for weight, outcome in material), 0.95)
+                  for material in export_data['materials']]
+
+    if objects:
+        scatter = sum(scattering[obj[0]] if obj[0] < len(scattering) else 0.0
+                      for obj in objects) / len(objects)
+    else:
+        scatter = 0.0
+    bounces = 1.0 / (1.0 - scatter)
+    traversal = 1.0 + log2(1.0 + len(objects))
+
+    return export_data['rays'] * (len(export_data['lights'])
+                                  + bounces * traversal)
+
+
+def measure_speed(hqz_bin_path, save_path):
+    '''Measure hqz's render time per unit of estimated cost, by rendering
+    an exported frame with few rays. Returns None if hqz can't be run.'''
+    with open(save_path) as file:
+        export_data = json.load(file)
+    export_data['rays'] = adaptive.CALIBRATION_RAYS
+    export_data.pop('timelimit', None)
+
+    elapsed = adaptive.time_render(hqz_bin_path, export_data)
+    if elapsed is None:
+        return None
+    return elapsed / estimate_cost(export_data)
+
+
+def report_budget(self, writer):
+    '''Report the total number of rays of exported frames, and predict
+    their render time on this computer if the writer measured hqz's
+    speed. Returns the render time per unit of estimated cost, or None
+    if it wasn't measured.'''
+    if not writer.costs:
+        return None
+
+    seconds_per_cost = writer.seconds_per_cost
+    message = 'Total {:,} rays in {} jobs'.format(sum(writer.rays.values()),
+                                                  len(writer.rays))
+    if seconds_per_cost is not None:
+        message += ', predicted render time {}'.format(adaptive.format_duration(
+            seconds_per_cost * sum(writer.costs.values())))
+    print(message)
+    self.report({'INFO'}, message)
+    return seconds_per_cost
+
+
+def write_manifest(export_dir, hqz_params, costs, merges, rays,
+                   seconds_per_cost=None):
+    '''Write the frames to render with their estimated cost and number of
+    rays.
+
+    This manifest is used by local_runner.py to render the most expensive
+    frames first. Sub-jobs of split frames render histograms, and name
+    the image they are merged into. If the render time per unit of cost
+    was measured, it is written to predict the render time.'''
+    frames = []
+    for save_path in sorted(costs):
+        frame = {'scene': save_path,
+                 'cost': costs[save_path],
+                 'rays': rays[save_path]}
+        if save_path in merges:
+            frame['image'] = os.path.splitext(save_path)[0] + '.hist'
+            frame['merge'] = merges[save_path]
+        else:
+            frame['image'] = os.path.splitext(save_path)[0] + '.png'
+        frames.append(frame)
+    manifest = {'hqz': bpy.path.abspath(hqz_params.hqz_bin_path),
+                'ignore': hqz_params.ignore,
+                'frames': frames}
+    if seconds_per_cost is not None:
+        manifest['seconds_per_cost'] = seconds_per_cost
+
+    file = open(os.path.join(export_dir, 'render.json'), 'w')
+    file.write(json.dumps(manifest, indent=2, sort_keys=True))
+    file.close()
+
+
+def check_export(self, context):
+    '''Check that the scene can be exported, reporting problems.'''
     sc = context.scene
-    cam = sc.camera
-    hqz_params = context.scene.hqz_parameters
-    rp = sc.render.resolution_percentage / 100.0
+    hqz_params = sc.hqz_parameters
 
     if not hqz_params.hqz_bin_path:
         self.report({'WARNING'}, 'Please select hqz binary.')
-    if not hqz_params.export_filepath:
-        self.report({'ERROR'}, 'Please choose export file name.')
-        return {'CANCELLED'}
-    if cam is None:
-        self.report({'ERROR'}, 'No camera found in scene.')
-        return {'CANCELLED'}
+    if not hqz_params.use_targets:
+        if not hqz_params.export_filepath:
+            self.report({'ERROR'}, 'Please choose export file name.')
+            return False
+        if sc.camera is None:
+            self.report({'ERROR'}, 'No camera found in scene.')
+            return False
+        return True
+
+    if not len(hqz_params.targets):
+        self.report({'ERROR'}, 'Please add export targets.')
+        return False
+    paths = set()
+    for target in hqz_params.targets:
+        cam = sc.objects.get(target.camera)
+        if cam is None or cam.type != 'CAMERA':
+            self.report({'ERROR'},
+                        'Target camera "{}" not found in scene.'.format(
+                            target.camera))
+            return False
+        if not target.export_filepath:
+            self.report({'ERROR'}, 'Please choose target file names.')
+            return False
+        # Targets writing the same files would overwrite each other
+        path = os.path.normcase(os.path.normpath(
+            bpy.path.abspath(target.export_filepath)))
+        if path in paths:
+            self.report({'ERROR'},
+                        'Several targets export to "{}".'.format(
+                            target.export_filepath))
+            return False
+        paths.add(path)
+    return True
+
+
+def get_targets(sc, hqz_params):
+    '''Get the cameras and resolutions to export the scene for.'''
+    if hqz_params.use_targets:
+        return [Target(sc.objects[target.camera],
+                       target.resolution_percentage,
+                       target.export_filepath)
+                for target in hqz_params.targets]
+    else:
+        return [Target(sc.camera,
+                       sc.render.resolution_percentage,
+                       hqz_params.export_filepath)]
+
 
+def get_frame_range(sc, hqz_params):
+    '''Get the frames to export.'''
     if hqz_params.animation:
-        start_frame = sc.frame_start
-        frame_range = range(sc.frame_start, sc.frame_end + 1)
+        return range(sc.frame_start, sc.frame_end + 1)
     else:
-        start_frame = sc.frame_current
-        frame_range = (start_frame,)
+        return (sc.frame_current,)
 
-    export_dir = os.path.dirname(
-        bpy.path.abspath(hqz_params.export_filepath)
-    )
 
-    os.makedirs(export_dir, exist_ok=True)
+def get_export_path(export_filepath, frame):
+    '''Get the json file path for the frame in argument.'''
+    return (export_filepath
+            + '.' + str(frame).zfill(4)
+            + '.json')
 
-    if hqz_params.render_script_path:
-        write_render_script(export_dir, hqz_params, frame_range)
 
-    export_data = {}
+def get_part_paths(export_filepath, frame, parts):
+    '''Get the json file paths of the sub-jobs of a split frame.'''
+    base = os.path.splitext(get_export_path(export_filepath, frame))[0]
+    return [base + '.part' + str(part) + '.json' for part in range(parts)]
+
+
+def split_frame(export_data, parts):
+    '''Split export data into sub-jobs, to render on several cores or
+    computers and merge with merge.py.
+
+    hqz seeds each ray with the scene seed plus the ray's index, so
+    sub-jobs with seeds as far apart as their numbers of rays trace
+    exactly the rays of the whole frame. Without a ray limit, seeds are
+    spread over the whole seed range.'''
+    rays = export_data['rays']
+    jobs = []
+    for part in range(parts):
+        job = dict(export_data)
+        if rays:
+            start = rays * part // parts
+            job['rays'] = rays * (part + 1) // parts - start
+        else:
+            start = (1 << 31) * part // parts
+        job['seed'] = (export_data['seed'] + start) % (1 << 31)
+        jobs.append(job)
+    return jobs
+
+
+def get_export_objects(sc):
+    '''Get the visible objects whose edges are exported.'''
+    return [obj for obj in sc.objects
+            if obj.type in {'MESH', 'CURVE', 'FONT', 'SURFACE'}
+            and obj.is_visible(sc)]
+
+
+def is_removed(obj):
+    '''Check whether an object was deleted since it was got.'''
+    try:
+        obj.name
+    except ReferenceError:
+        return True
+    return False
+
+
+def export_settings(sc, hqz_params, target):
+    '''Get the image settings and stopping conditions.'''
+    width, height = get_target_size(sc, target)
+    settings = {}
+    settings['resolution'] = [int(width), int(height)]
+    settings['viewport'] = [0, 0, width, height]
+    settings['exposure'] = hqz_params.exposure
+    settings['gamma'] = hqz_params.gamma
+    settings['rays'] = hqz_params.rays
+    if hqz_params.time != 0.0:
+        settings['timelimit'] = hqz_params.time
+    settings['seed'] = hqz_params.seed
+    return settings
+
+
+def export_lights(sc, target):
+    '''Get the lights as seen from the target camera.'''
+    cam = target.camera
+    width, height = get_target_size(sc, target)
+    lights = []
+    for lamp in sc.objects:
+        if lamp.type == 'LAMP' and lamp.is_visible(sc):
+            lamp_obstacle = False
+
+            if not lamp_obstacle:
+                hqz_light = []
+                use_spectral = lamp.data.hqz_lamp.use_spectral_light
+                spectral_start = lamp.data.hqz_lamp.spectral_start
+                spectral_end = lamp.data.hqz_lamp.spectral_end
+                wav = color_to_wavelength(lamp.data.color)
+                lamp_loc = lamp.matrix_world.to_translation()
+                x, y, z = world_to_camera_view(
+                    sc, cam,
+                    lamp_loc)
+                x *= width
+                y *= height
+
+                if z > 0:  # Check that lamp is not behind camera
+                    y = height - y
+                    hqz_light.append(lamp.data.energy)
+                    hqz_light.append(x)
+                    hqz_light.append(y)
+                    if lamp.data.type == 'SPOT':
+                        lamp_angle = get_object_rot(sc, target, lamp)
+                        lamp_size = degrees(lamp.data.spot_size) / 2.0
+                        lamp_min = (lamp_angle - lamp_size)
+                        lamp_max = (lamp_angle + lamp_size)
+                        hqz_light.append([lamp_min, lamp_max])
+                    else:
+                        hqz_light.append([0, 360])
+                    light_start = (
+                        lamp.data.hqz_lamp.light_start
+                        * height)
+                    light_end = (
+                        lamp.data.hqz_lamp.light_end
+                        * height)
+                    hqz_light.append([light_start,
+                                      light_end])
+                    if lamp.data.type == 'SPOT':
+                        hqz_light.append([lamp_min, lamp_max])
+                    else:
+                        hqz_light.append([0, 360])
+                    if use_spectral:
+                        hqz_light.append([spectral_start, spectral_end])
+                    else:
+                        hqz_light.append(wav)
+                lights.append(hqz_light)
+    return lights
+
+
+def get_mesh_cache(hqz_params):
+    '''Get the mesh cache of the export settings, or None if it isn't
+    used.'''
+    if not hqz_params.use_mesh_cache:
+        return None
+    directory = hqz_params.mesh_cache_dir
+    if directory.startswith('//') and not bpy.data.filepath:
+        # Relative to an unsaved file, only cache for this session
+        directory = os.path.join(bpy.app.tempdir, directory[2:])
+    try:
+        return cache.MeshCache(bpy.path.abspath(directory),
+                               hqz_params.mesh_cache_size * 1000000)
+    except OSError as e:
+        print('Mesh cache disabled:', e)
+        return None
+
+
+def hash_arrays(digest, fields):
+    '''Add attributes of collection items to a hash. Fields are tuples
+    of a collection, an attribute, its number of values and their
+    type.'''
+    for collection, attribute, size, dtype in fields:
+        values = np.empty(len(collection) * size, dtype=dtype)
+        collection.foreach_get(attribute, values)
+        digest.update(values.tobytes())
+
+
+def get_settings(struct):
+    '''Get the identifiers and values of a struct's properties, as
+    hashable values. Collections and nested structs are skipped, and data
+    blocks are kept as is.'''
+    settings = []
+    for prop in struct.bl_rna.properties:
+        if prop.identifier == 'rna_type' or prop.type == 'COLLECTION':
+            continue
+        value = getattr(struct, prop.identifier)
+        if isinstance(value, bpy.types.ID):
+            pass
+        elif prop.type == 'POINTER':
+            # Nested structs, like curve mappings
+            continue
+        elif isinstance(value, set):
+            value = tuple(sorted(value))
+        elif getattr(prop, 'array_length', 0) > 0:
+            # bpy_prop_array's repr is its path, not its values
+            value = tuple(value)
+        settings.append((prop.identifier, value))
+    return settings
+
+
+def get_data_key(struct):
+    '''Get the settings of a struct, with data blocks by name.'''
+    return tuple((identifier, value.name)
+                 if isinstance(value, bpy.types.ID) else (identifier, value)
+                 for identifier, value in get_settings(struct))
+
+
+def hash_shape_keys(digest, shape_keys):
+    '''Add the points and values of mesh or lattice shape keys, if any,
+    to a hash.'''
+    if shape_keys is None:
+        return
+    for key_block in shape_keys.key_blocks:
+        hash_arrays(digest, ((key_block.data, 'co', 3, np.float32),))
+        digest.update(repr((key_block.value, key_block.mute)).encode())
+
+
+def hash_mesh(mesh):
+    '''Hash the data of a mesh which its evaluation depends on, including
+    the creases and bevel weights read by subdivision and bevel
+    modifiers.'''
+    digest = hashlib.sha1()
+    hash_arrays(digest, (
+        (mesh.vertices, 'co', 3, np.float32),
+        (mesh.vertices, 'bevel_weight', 1, np.float32),
+        (mesh.edges, 'vertices', 2, np.int32),
+        (mesh.edges, 'crease', 1, np.float32),
+        (mesh.edges, 'bevel_weight', 1, np.float32),
+        (mesh.polygons, 'loop_total', 1, np.int32),
+        (mesh.loops, 'vertex_index', 1, np.int32)))
+    marks = [False] * len(mesh.edges)
+    mesh.edges.foreach_get('use_freestyle_mark', marks)
+    digest.update(bytes(marks))
+    hash_shape_keys(digest, mesh.shape_keys)
+    return digest.hexdigest()
+
+
+def hash_lattice(lattice):
+    '''Hash the resolution and deformed points of a lattice.'''
+    digest = hashlib.sha1(repr(get_data_key(lattice)).encode())
+    hash_arrays(digest, ((lattice.points, 'co_deform', 3, np.float32),))
+    hash_shape_keys(digest, lattice.shape_keys)
+    return digest.hexdigest()
+
+
+def hash_curve(curve):
+    '''Hash the settings and points of a curve, or get None if it has
+    shape keys, which aren't read.'''
+    if curve.shape_keys is not None:
+        return None
+    digest = hashlib.sha1(repr(get_data_key(curve)).encode())
+    for spline in curve.splines:
+        digest.update(repr(get_data_key(spline)).encode())
+        hash_arrays(digest, (
+            (spline.bezier_points, 'co', 3, np.float32),
+            (spline.bezier_points, 'handle_left', 3, np.float32),
+            (spline.bezier_points, 'handle_right', 3, np.float32),
+            (spline.bezier_points, 'radius', 1, np.float32),
+            (spline.bezier_points, 'tilt', 1, np.float32),
+            (spline.points, 'co', 4, np.float32),
+            (spline.points, 'radius', 1, np.float32),
+            (spline.points, 'tilt', 1, np.float32),
+            (spline.points, 'weight', 1, np.float32)))
+    return digest.hexdigest()
+
+
+def hash_pose(obj):
+    '''Hash the pose of an armature object and its rest pose.'''
+    digest = hashlib.sha1(obj.data.pose_position.encode())
+    for bone in obj.pose.bones:
+        digest.update(bone.name.encode())
+        for matrix in (bone.matrix, bone.bone.matrix_local):
+            digest.update(np.array(matrix, dtype=np.float32).tobytes())
+    return digest.hexdigest()
+
+
+def get_object_key(obj):
+    '''Get the transform and data of an object which a modifier of
+    another object depends on, or None if its changes can't be seen.'''
+    # Objects in edit mode aren't up to date
+    if obj.mode == 'EDIT':
+        return None
+    if obj.type == 'MESH':
+        data = hash_mesh(obj.data)
+    elif obj.type == 'LATTICE':
+        data = hash_lattice(obj.data)
+    elif obj.type == 'CURVE':
+        data = hash_curve(obj.data)
+        if data is None:
+            return None
+    elif obj.type == 'ARMATURE':
+        data = hash_pose(obj)
+    elif obj.type == 'EMPTY':
+        data = None
+    else:
+        return None
+    matrix = tuple(tuple(row) for row in obj.matrix_world)
+    return (obj.name, matrix, data)
+
+
+def get_modifier_key(modifier):
+    '''Get the settings of a modifier, including the objects it uses, or
+    None if it uses an object whose changes can't be seen.'''
+    values = [modifier.type]
+    for identifier, value in get_settings(modifier):
+        if isinstance(value, bpy.types.Object):
+            value = get_object_key(value)
+            if value is None:
+                return None
+        elif isinstance(value, bpy.types.ID):
+            value = value.name
+        values.append((identifier, value))
+    return tuple(values)
+
+
+def get_cache_key(sc, hqz_params, obj):
+    '''Get the key of an object's evaluated edges in the mesh cache, or
+    None if it can't be cached.
+
+    The key holds the object's transform, its modifier settings, a hash
+    of its mesh data, with edge creases and bevel weights, and the
+    frame, for animated modifiers. Objects used by modifiers add their
+    transform and a hash of their mesh, lattice, curve or pose. Objects
+    using other kinds of objects aren't cached. Changes the key doesn't
+    see, like vertex weights or drivers, need the cache to be
+    cleared.'''
+    # Meshes in edit mode aren't up to date
+    if obj.type != 'MESH' or obj.mode == 'EDIT':
+        return None
+    modifiers = []
+    for modifier in obj.modifiers:
+        if modifier.show_viewport:
+            modifier_key = get_modifier_key(modifier)
+            if modifier_key is None:
+                return None
+            modifiers.append(modifier_key)
+    return (obj.name, sc.frame_current, hqz_params.normals_export,
+            tuple(tuple(row) for row in obj.matrix_world),
+            tuple(modifiers), hash_mesh(obj.data))
+
+
+def edges_to_array(edges, normals):
+    '''Convert evaluated edges to an array of shape (edges, points, 3),
+    with 4 points per edge with normals, or 2.'''
+    points = 4 if normals else 2
+    if not edges:
+        return np.zeros((0, points, 3))
+    return np.array([[tuple(point) for point in edge[:points]]
+                     for edge in edges])
+
+
+def edges_from_array(array):
+    '''Convert an array of edges back to evaluated edges.'''
+    if array.shape[1] == 4:
+        return [tuple(Vector(point) for point in edge) for edge in array]
+    return [(Vector(edge[0]), Vector(edge[1]), None, None)
+            for edge in array]
+
+
+def evaluate_object(sc, hqz_params, obj, mesh_cache=None):
+    '''Get the edges of an object in world space.
+
+    Each edge is a tuple of its two vertices, and of the two points
+    offset from them along their normal, if normals are exported. With a
+    mesh cache, edges are loaded from the cache if the object didn't
+    change since they were stored.'''
+    key = None
+    if mesh_cache is not None:
+        key = get_cache_key(sc, hqz_params, obj)
+        if key is not None:
+            array = mesh_cache.get(key)
+            if array is not None:
+                return edges_from_array(array)
+
+    edges = []
+    mesh = bpy.data.meshes.new_from_object(
+        sc, obj, apply_modifiers=True, settings='PREVIEW')
+    for edge in mesh.edges:
+        if edge.use_freestyle_mark:
+            continue
+        vertices = list(edge.vertices)
+        v1 = obj.matrix_world * mesh.vertices[vertices[0]].co
+        v2 = obj.matrix_world * mesh.vertices[vertices[1]].co
+        if hqz_params.normals_export:
+            v1_normal_offset = (
+                obj.matrix_world
+                * (mesh.vertices[vertices[0]].co
+                   + mesh.vertices[vertices[0]].normal)
+                )
+            v2_normal_offset = (
+                obj.matrix_world
+                * (mesh.vertices[vertices[1]].co
+                   + mesh.vertices[vertices[1]].normal)
+                )
+        else:
+            v1_normal_offset = v2_normal_offset = None
+        edges.append((v1, v2, v1_normal_offset, v2_normal_offset))
+    bpy.data.meshes.remove(mesh)
+
+    if key is not None:
+        mesh_cache.put(key, edges_to_array(edges, hqz_params.normals_export))
+    return edges
+
+
+def project_object(sc, hqz_params, target, material_id, edges):
+    '''Project the world space edges of an object for the target camera.'''
+    cam = target.camera
+    width, height = get_target_size(sc, target)
+    objects = []
+    for v1, v2, v1_normal_offset, v2_normal_offset in edges:
+        edge_data = []
+        # MATERIAL
+        edge_data.append(material_id)
+        v1_cam = world_to_camera_view(
+            sc, cam, v1)
+        v2_cam = world_to_camera_view(
+            sc, cam, v2)
+        # VERT1 XPOS
+        edge_data.append(
+            v1_cam.x * width)
+        # VERT1 YPOS
+        edge_data.append(
+            (1 - v1_cam.y) * height)
+        # VERT2 DELTA XPOS
+        edge_data.append(
+            (v2_cam.x - v1_cam.x) * width
+        )
+        # VERT2 DELTA YPOS
+        edge_data.append(
+            (v1_cam.y - v2_cam.y) * height
+        )
+        if hqz_params.normals_export:
+            n1 = get_normal_from_points(
+                sc, target, v1, v1_normal_offset)
+            n2 = get_normal_from_points(
+                sc, target, v2, v2_normal_offset)
+            if n1.length_squared and n2.length_squared:
+                # Do not export normals if parallel to camera axis
+                n1_angle = degrees(Vector((1.0, 0.0)).angle_signed(n1))
+                n2_angle = degrees(n1.angle_signed(n2))
+                if hqz_params.normals_invert:
+                    n1_angle += 180
+                # VERT1 NORMAL
+                edge_data.insert(3, n1_angle)
+                # VERT2 NORMAL
+                edge_data.append(n2_angle)
+
+        objects.append(edge_data)
+    return objects
+
+
+def export_materials(hqz_params):
+    '''Get the materials list.'''
+    materials = []
+    for material in hqz_params.materials:
+        mat_data = []
+        mat_data.append([material.diffuse, "d"])
+        mat_data.append([material.transmission, "t"])
+        mat_data.append([material.specular, "r"])
+        materials.append(mat_data)
+    return materials
+
+
+def iter_progress(steps, start, end):
+    '''Run a generator yielding the fraction of its work done, yielding
+    progress from start to end instead. Returns the generator's value.'''
+    while True:
+        try:
+            fraction = next(steps)
+        except StopIteration as done:
+            return done.value
+        yield start + (end - start) * fraction
+
+
+def iter_export_frame(sc, hqz_params, targets, frame_data, mesh_cache=None):
+    '''Fill export data of each target for the current frame.
+
+    Objects are evaluated once in world space, or loaded from the mesh
+    cache, then projected for each target. This generator yields the
+    fraction of the frame done after each object and batch of culling
+    probes, so that the export may be interrupted between them.'''
+    for target, export_data in zip(targets, frame_data):
+        export_data.update(export_settings(sc, hqz_params, target))
+        export_data['lights'] = export_lights(sc, target)
+        export_data['objects'] = []
+
+    frame = sc.frame_current
+    objects = get_export_objects(sc)
+    for obj_i, obj in enumerate(objects):
+        # The scene may have been edited while this generator was paused
+        if sc.frame_current != frame:
+            sc.frame_set(frame)
+        if is_removed(obj):
+            continue
+        edges = evaluate_object(sc, hqz_params, obj, mesh_cache)
+        for target, export_data in zip(targets, frame_data):
+            export_data['objects'].extend(project_object(
+                sc, hqz_params, target, obj.hqz_material_id, edges))
+        yield (obj_i + 1) / (len(objects) + 1)
+
+    materials = export_materials(hqz_params)
+    for export_data in frame_data:
+        export_data['materials'] = materials
+
+    if hqz_params.cull_unreachable:
+        # Culling all targets is the last object's worth of progress
+        step = 1.0 / (len(objects) + 1) / len(targets)
+        for target_i, (target, export_data) in enumerate(zip(targets,
+                                                             frame_data)):
+            start = len(objects) / (len(objects) + 1) + target_i * step
+            report = yield from iter_progress(
+                culling.iter_cull_unreachable(export_data,
+                                              hqz_params.cull_probes),
+                start, start + step)
+            print(target.camera.name + ':', report)
+
+
+def write_frame(save_path, export_data, debug):
+    '''Serialize export data and write it to file.'''
+    d = os.path.dirname(save_path)
+    os.makedirs(d, exist_ok=True)
+
+    file = open(save_path, 'w')
+    file.write(json.dumps(
+                          export_data,
+                          indent=None if debug else 2,
+                          sort_keys=True)
+               )
+    file.close()
+
 
-    for frame in frame_range:
+class FrameWriter(threading.Thread):
+    '''Background thread serializing and writing exported frames.
+
+    Frames are written in the order they were queued, and their render
+    cost is estimated. If hqz's path is given, its speed is then measured
+    on the most expensive frame, to predict the render time. Errors are
+    stored to be reported from the main thread, as bpy is not thread
+    safe.'''
+
+    def __init__(self, hqz_bin_path=None):
+        super().__init__(daemon=True)
+        self.queue = queue.Queue()
+        self.errors = []
+        self.costs = {}
+        self.rays = {}
+        self.merges = {}
+        self.hqz_bin_path = hqz_bin_path
+        self.seconds_per_cost = None
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            save_path, export_data, debug, merge = item
+            try:
+                write_frame(save_path, export_data, debug)
+                cost = estimate_cost(export_data)
+            except Exception as e:
+                # Keep writing the next frames
+                self.errors.append('{}: {}'.format(save_path, e))
+            else:
+                self.costs[save_path] = cost
+                self.rays[save_path] = export_data['rays']
+                if merge is not None:
+                    self.merges[save_path] = merge
+
+        # Cleared if the export was cancelled meanwhile
+        if self.hqz_bin_path and self.costs:
+            save_path = max(self.costs, key=self.costs.get)
+            try:
+                self.seconds_per_cost = measure_speed(self.hqz_bin_path,
+                                                      save_path)
+            except Exception as e:
+                self.errors.append('{}: {}'.format(save_path, e))
+
+    def put(self, save_path, export_data, debug, merge=None):
+        '''Queue a frame, or a sub-job to be merged into the merge
+        image.'''
+        self.queue.put((save_path, export_data, debug, merge))
+
+    def close(self):
+        '''Stop once all queued frames are written, without waiting.'''
+        self.queue.put(None)
+
+    def finish(self):
+        '''Wait until all queued frames are written.'''
+        self.close()
+        self.join()
+
+
+def start_writer(hqz_params):
+    '''Start a frame writer, measuring hqz's speed if frames have an
+    adaptive number of rays.'''
+    hqz_bin_path = None
+    if hqz_params.use_adaptive_rays and hqz_params.hqz_bin_path:
+        hqz_bin_path = bpy.path.abspath(hqz_params.hqz_bin_path)
+    writer = FrameWriter(hqz_bin_path)
+    writer.start()
+    return writer
+
+
+def iter_export(context, writer, targets, frame_range):
+    '''Export frames, handing each one to the writer once complete.
+
+    This generator yields the number of frames done, as a float, after
+    each exported object and batch of pilot rays.'''
+    sc = context.scene
+    hqz_params = sc.hqz_parameters
+    mesh_cache = get_mesh_cache(hqz_params)
+
+    for frame_i, frame in enumerate(frame_range):
         print('Exporting frame', frame)
 
         if hqz_params.animation:
             sc.frame_set(frame)
 
-        # SETTINGS
-        export_data['resolution'] = [
-            int(sc.render.resolution_x * rp),
-            int(sc.render.resolution_y * rp)]
-        export_data['viewport'] = [
-            0, 0,
-            sc.render.resolution_x * rp,
-            sc.render.resolution_y * rp]
-        export_data['exposure'] = hqz_params.exposure
-        export_data['gamma'] = hqz_params.gamma
-        export_data['rays'] = hqz_params.rays
-        if hqz_params.time != 0.0:
-            export_data['timelimit'] = hqz_params.time
-        export_data['seed'] = hqz_params.seed
-
-        # LIGHTS
-        export_data['lights'] = []
-        for lamp in sc.objects:
-            if lamp.type == 'LAMP' and lamp.is_visible(sc):
-                lamp_obstacle = False
-
-                if not lamp_obstacle:
-                    hqz_light = []
-                    use_spectral = lamp.data.hqz_lamp.use_spectral_light
-                    spectral_start = lamp.data.hqz_lamp.spectral_start
-                    spectral_end = lamp.data.hqz_lamp.spectral_end
-                    wav = color_to_wavelength(lamp.data.color)
-                    lamp_loc = lamp.matrix_world.to_translation()
-                    x, y, z = world_to_camera_view(
-                        sc, cam,
-                        lamp_loc)
-                    x *= sc.render.resolution_x * rp
-                    y *= sc.render.resolution_y * rp
-
-                    if z > 0:  # Check that lamp is not behind camera
-                        y = sc.render.resolution_y * rp - y
-                        hqz_light.append(lamp.data.energy)
-                        hqz_light.append(x)
-                        hqz_light.append(y)
-                        if lamp.data.type == 'SPOT':
-                            lamp_angle = get_object_rot(sc, lamp)
-                            lamp_size = degrees(lamp.data.spot_size) / 2.0
-                            lamp_min = (lamp_angle - lamp_size)
-                            lamp_max = (lamp_angle + lamp_size)
-                            hqz_light.append([lamp_min, lamp_max])
-                        else:
-                            hqz_light.append([0, 360])
-                        light_start = (
-                            lamp.data.hqz_lamp.light_start
-                            * (sc.render.resolution_y * rp))
-                        light_end = (
-                            lamp.data.hqz_lamp.light_end
-                            * (sc.render.resolution_y * rp))
-                        hqz_light.append([light_start,
-                                          light_end])
-                        if lamp.data.type == 'SPOT':
-                            hqz_light.append([lamp_min, lamp_max])
-                        else:
-                            hqz_light.append([0, 360])
-                        if use_spectral:
-                            hqz_light.append([spectral_start, spectral_end])
-                        else:
-                            hqz_light.append(wav)
-                    export_data['lights'].append(hqz_light)
+        frame_data = [{} for target in targets]
+        progress = 0.0
+        for progress in iter_export_frame(sc, hqz_params, targets,
+                                          frame_data, mesh_cache):
+            yield frame_i + progress
+
+        for target, export_data in zip(targets, frame_data):
+            if hqz_params.use_adaptive_rays:
+                # Pilot renders don't advance the progress
+                export_data['rays'] = yield from iter_progress(
+                    adaptive.iter_choose_rays(
+                        export_data, hqz_params.adaptive_noise,
+                        hqz_params.adaptive_pilot_rays, hqz_params.rays),
+                    frame_i + progress, frame_i + progress)
+
+            save_path = get_export_path(target.export_filepath, frame)
+            if hqz_params.sub_jobs > 1:
+                image_path = os.path.splitext(save_path)[0] + '.png'
+                for part_path, job in zip(
+                        get_part_paths(target.export_filepath, frame,
+                                       hqz_params.sub_jobs),
+                        split_frame(export_data, hqz_params.sub_jobs)):
+                    writer.put(part_path, job, hqz_params.debug, image_path)
+            else:
+                writer.put(save_path, export_data, hqz_params.debug)
+        yield frame_i + 1
+
+    if mesh_cache is not None:
+        print(mesh_cache)
+
+
+def get_export_dir(targets):
+    '''Get the directory where the render script is written.'''
+    return os.path.dirname(
+        bpy.path.abspath(targets[0].export_filepath)
+    )
 
-        export_data['objects'] = []
 
-        # OBJECTS
-        for obj in sc.objects:
-            if (
-                    obj.type in {'MESH', 'CURVE', 'FONT', 'SURFACE'}
-                    and obj.is_visible(sc)
-                    ):
-                mesh = bpy.data.meshes.new_from_object(
-                    sc, obj, apply_modifiers=True, settings='PREVIEW')
-                for edge in mesh.edges:
-                    if edge.use_freestyle_mark:
-                        continue
-                    edge_data = []
-                    vertices = list(edge.vertices)
-                    # MATERIAL
-                    edge_data.append(obj.hqz_material_id)
-                    v1 = obj.matrix_world * mesh.vertices[vertices[0]].co
-                    v2 = obj.matrix_world * mesh.vertices[vertices[1]].co
-                    v1_cam = world_to_camera_view(
-                        sc, cam, v1)
-                    v2_cam = world_to_camera_view(
-                        sc, cam, v2)
-                    # VERT1 XPOS
-                    edge_data.append(
-                        v1_cam.x * sc.render.resolution_x * rp)
-                    # VERT1 YPOS
-                    edge_data.append(
-                        (1 - v1_cam.y) * sc.render.resolution_y * rp)
-                    # VERT2 DELTA XPOS
-                    edge_data.append(
-                        (v2_cam.x - v1_cam.x)
-                        * sc.render.resolution_x * rp
-                    )
-                    # VERT2 DELTA YPOS
-                    edge_data.append(
-                        (v1_cam.y - v2_cam.y)
-                        * sc.render.resolution_y * rp
-                    )
-                    if hqz_params.normals_export:
-                        v1_normal_offset = (
-                            obj.matrix_world
-                            * (mesh.vertices[vertices[0]].co
-                               + mesh.vertices[vertices[0]].normal)
-                            )
-                        v2_normal_offset = (
-                            obj.matrix_world
-                            * (mesh.vertices[vertices[1]].co
-                               + mesh.vertices[vertices[1]].normal)
-                            )
-                        n1 = get_normal_from_points(
-                            sc, obj, v1, v1_normal_offset)
-                        n2 = get_normal_from_points(
-                            sc, obj, v2, v2_normal_offset)
-                        if n1.length_squared and n2.length_squared:
-                            # Do not export normals if parallel to camera axis
-                            n1_angle = degrees(Vector((1.0, 0.0)).angle_signed(n1))
-                            n2_angle = degrees(n1.angle_signed(n2))
-                            if hqz_params.normals_invert:
-                                n1_angle += 180
-                            # VERT1 NORMAL
-                            edge_data.insert(3, n1_angle)
-                            # VERT2 NORMAL
-                            edge_data.append(n2_angle)
-
-                    export_data['objects'].append(edge_data)
-                bpy.data.meshes.remove(mesh)
-
-        # Materials
-        export_data['materials'] = []
-        for material in hqz_params.materials:
-            mat_data = []
-            mat_data.append([material.diffuse, "d"])
-            mat_data.append([material.transmission, "t"])
-            mat_data.append([material.specular, "r"])
-            export_data['materials'].append(mat_data)
-
-        save_path = (hqz_params.export_filepath
-                     + '.' + str(frame).zfill(4)
-                     + '.json')
-
-        d = os.path.dirname(save_path)
-        os.makedirs(d, exist_ok=True)
-
-        file = open(save_path, 'w')
-        file.write(json.dumps(
-                              export_data,
-                              indent=None if hqz_params.debug else 2,
-                              sort_keys=True)
-                   )
-        file.close()
+def export(self, context):
+    '''Create export data and write to file.'''
+    if not check_export(self, context):
+        return {'CANCELLED'}
+
+    sc = context.scene
+    hqz_params = sc.hqz_parameters
+    targets = get_targets(sc, hqz_params)
+    frame_range = get_frame_range(sc, hqz_params)
+
+    export_dir = get_export_dir(targets)
+
+    os.makedirs(export_dir, exist_ok=True)
+
+    if hqz_params.render_script_path:
+        write_render_script(export_dir, hqz_params, frame_range,
+                            [target.export_filepath for target in targets])
+
+    writer = start_writer(hqz_params)
+    for progress in iter_export(context, writer, targets, frame_range):
+        pass
+    writer.finish()
+
+    seconds_per_cost = None
+    if hqz_params.use_adaptive_rays:
+        seconds_per_cost = report_budget(self, writer)
+
+    if hqz_params.render_script_path:
+        write_manifest(export_dir, hqz_params, writer.costs, writer.merges,
+                       writer.rays, seconds_per_cost)
+
+    if writer.errors:
+        self.report({'ERROR'}, '\n'.join(writer.errors))
+        return {'CANCELLED'}
     return {'FINISHED'}
 
 
+# WATCH MODE
+
+class WatchState:
+    '''Cached export data of the current frame, updated as the scene
+    changes.
+
+    Objects are evaluated in world space, then projected for each target.
+    Both steps are cached, and only redone for objects which changed.
+    Lights, settings and materials are cheap, and always exported.'''
+
+    def __init__(self):
+        # World space edges, by object name
+        self.edges = {}
+        # Projected segments, by (target index, object name)
+        self.projected = {}
+        # Names of objects changed since the last export
+        self.dirty = set()
+        self.camera_dirty = False
+        # Time of the last change, or None if the export is up to date
+        self.changed = 0.0
+        self.options = None
+        self.views = None
+        self.render = None
+        self.stop = False
+
+    def forget(self, names):
+        '''Drop cached data of objects which aren't in names, or
+        changed.'''
+        for name in list(self.edges):
+            if name not in names or name in self.dirty:
+                del self.edges[name]
+        for key in list(self.projected):
+            if (self.camera_dirty or key[1] not in names
+                    or key[1] in self.dirty):
+                del self.projected[key]
+        self.dirty.clear()
+        self.camera_dirty = False
+
+
+def watch_scene_update(sc):
+    '''Mark objects changed by the last scene update as dirty.'''
+    state = HQZWatch.state
+    if state is None:
+        return
+    if bpy.data.objects.is_updated:
+        for obj in sc.objects:
+            if obj.is_updated or obj.is_updated_data:
+                if obj.type == 'CAMERA':
+                    state.camera_dirty = True
+                else:
+                    state.dirty.add(obj.name)
+                state.changed = time.time()
+    if sc.is_updated:
+        state.changed = time.time()
+
+
+def export_watched_frame(sc, hqz_params, targets, state):
+    '''Export the current frame for each target, only evaluating and
+    projecting objects which changed since the last export.'''
+    # Evaluated edges depend on these settings
+    options = (hqz_params.normals_export, hqz_params.normals_invert)
+    if options != state.options:
+        state.options = options
+        state.edges.clear()
+        state.projected.clear()
+
+    # Projected segments depend on the camera and pixel size of each
+    # target, which change with the scene camera, the targets or the
+    # render settings
+    views = [(target.camera.name, get_target_size(sc, target),
+              sc.render.pixel_aspect_x, sc.render.pixel_aspect_y)
+             for target in targets]
+    if views != state.views:
+        state.views = views
+        state.projected.clear()
+
+    objects = get_export_objects(sc)
+    state.forget({obj.name for obj in objects})
+
+    materials = export_materials(hqz_params)
+    frame_data = []
+    for target_i, target in enumerate(targets):
+        export_data = export_settings(sc, hqz_params, target)
+        export_data['lights'] = export_lights(sc, target)
+        export_data['objects'] = []
+        for obj in objects:
+            if obj.name not in state.edges:
+                state.edges[obj.name] = evaluate_object(sc, hqz_params, obj)
+            key = (target_i, obj.name)
+            if key not in state.projected:
+                state.projected[key] = project_object(
+                    sc, hqz_params, target, obj.hqz_material_id,
+                    state.edges[obj.name])
+            export_data['objects'].extend(state.projected[key])
+        export_data['materials'] = materials
+
+        if hqz_params.cull_unreachable:
+            culling.cull_unreachable(export_data, hqz_params.cull_probes)
+        frame_data.append(export_data)
+    return frame_data
+
+
+def show_image(context, image):
+    '''Show an image in an open image editor, if any.'''
+    for area in context.screen.areas:
+        if area.type == 'IMAGE_EDITOR':
+            area.spaces.active.image = image
+            break
+
+
 # Operators
 
 class HQZExport(bpy.types.Operator):
+    '''Export scene to hqz files (Esc to cancel)'''
     bl_label = "Export scene"
     bl_idname = "render.hqz_export"
 
+    # Maximum time spent exporting between two UI updates, in seconds
+    time_slice = 0.1
+
+    # Whether an export is running in the background
+    running = False
+
     def execute(self, context):
+        if HQZExport.running:
+            self.report({'ERROR'}, 'An export is already running.')
+            return {'CANCELLED'}
         return export(self, context)
 
+    def invoke(self, context, event):
+        if HQZExport.running:
+            self.report({'ERROR'}, 'An export is already running.')
+            return {'CANCELLED'}
+        if not check_export(self, context):
+            return {'CANCELLED'}
+
+        sc = context.scene
+        hqz_params = sc.hqz_parameters
+        self.targets = get_targets(sc, hqz_params)
+        self.frame_range = get_frame_range(sc, hqz_params)
+        self.frames_done = 0
+        self.frame_current = sc.frame_current
+        # Whether all frames are exported, waiting for the writer
+        self.exported = False
+
+        self.export_dir = get_export_dir(self.targets)
+        os.makedirs(self.export_dir, exist_ok=True)
+
+        self.writer = start_writer(hqz_params)
+        self.steps = iter_export(context, self.writer,
+                                 self.targets, self.frame_range)
+
+        wm = context.window_manager
+        wm.progress_begin(0, len(self.frame_range))
+        self.timer = wm.event_timer_add(0.01, context.window)
+        wm.modal_handler_add(self)
+        HQZExport.running = True
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            self.report({'WARNING'},
+                        'Export cancelled after {} frame(s).'.format(
+                            self.frames_done))
+            # Don't wait for hqz's speed to be measured
+            self.writer.hqz_bin_path = None
+            return self.finish(context, {'CANCELLED'})
+
+        if event.type == 'TIMER' and self.exported:
+            # The writer measures hqz's speed once all frames are written
+            if not self.writer.is_alive():
+                return self.finish(context, {'FINISHED'})
+
+        elif event.type == 'TIMER':
+            slice_end = time.time() + self.time_slice
+            try:
+                for progress in self.steps:
+                    self.frames_done = int(progress)
+                    context.window_manager.progress_update(progress)
+                    if time.time() > slice_end:
+                        break
+                else:
+                    self.exported = True
+                    self.writer.close()
+            except ReferenceError:
+                # A target camera was deleted while exporting
+                self.report({'ERROR'},
+                            'Export cancelled after {} frame(s): a camera '
+                            'was deleted.'.format(self.frames_done))
+                return self.finish(context, {'CANCELLED'})
+            except Exception as e:
+                # Stop cleanly, so that later exports aren't refused
+                traceback.print_exc()
+                self.report({'ERROR'},
+                            'Export cancelled after {} frame(s): {}'.format(
+                                self.frames_done, e))
+                return self.finish(context, {'CANCELLED'})
+
+        return {'PASS_THROUGH'}
+
+    def finish(self, context, result):
+        '''Wait for queued frames, write render script and clean up.'''
+        wm = context.window_manager
+        wm.event_timer_remove(self.timer)
+        HQZExport.running = False
+        # Drop the partially exported frame, if any
+        self.steps.close()
+        self.writer.finish()
+        wm.progress_end()
+
+        sc = context.scene
+        hqz_params = sc.hqz_parameters
+        if hqz_params.animation:
+            sc.frame_set(self.frame_current)
+
+        seconds_per_cost = None
+        if hqz_params.use_adaptive_rays:
+            seconds_per_cost = report_budget(self, self.writer)
+
+        # Only render frames which were completely exported
+        if hqz_params.render_script_path and self.frames_done:
+            frames = self.frame_range[:self.frames_done]
+            write_render_script(
+                self.export_dir, hqz_params, frames,
+                [target.export_filepath for target in self.targets])
+            done = set()
+            for frame in frames:
+                for target in self.targets:
+                    done.add(get_export_path(target.export_filepath, frame))
+                    done.update(get_part_paths(target.export_filepath, frame,
+                                               hqz_params.sub_jobs))
+            costs = {save_path: cost
+                     for save_path, cost in self.writer.costs.items()
+                     if save_path in done}
+            write_manifest(self.export_dir, hqz_params, costs,
+                           self.writer.merges, self.writer.rays,
+                           seconds_per_cost)
+
+        if self.writer.errors:
+            self.report({'ERROR'}, '\n'.join(self.writer.errors))
+            return {'CANCELLED'}
+        return result
+
+
+class HQZPreview(bpy.types.Operator):
+    '''Trace a quick lighting preview of the current frame'''
+    bl_label = "Preview lighting"
+    bl_idname = "render.hqz_preview"
+
+    def execute(self, context):
+        sc = context.scene
+        hqz_params = sc.hqz_parameters
+        if sc.camera is None:
+            self.report({'ERROR'}, 'No camera in scene.')
+            return {'CANCELLED'}
+
+        # Preview the scene camera, without writing anything to disk
+        target = Target(sc.camera, sc.render.resolution_percentage, '')
+        export_data = {}
+        for progress in iter_export_frame(sc, hqz_params,
+                                          [target], [export_data],
+                                          get_mesh_cache(hqz_params)):
+            pass
+
+        warnings = []
+        pixels = preview.render(export_data, hqz_params.preview_rays,
+                                warnings=warnings)
+        for warning in warnings:
+            self.report({'WARNING'}, warning)
+        height, width = pixels.shape[:2]
+
+        image = bpy.data.images.get('HQZ Preview')
+        if image is None or tuple(image.size) != (width, height):
+            if image is not None:
+                bpy.data.images.remove(image)
+            image = bpy.data.images.new('HQZ Preview', width, height)
+
+        # Blender images are RGBA floats, from the bottom row up
+        rgba = np.ones((height, width, 4))
+        rgba[:, :, :3] = pixels[::-1] / 255.0
+        image.pixels = rgba.ravel()
+
+        show_image(context, image)
+        return {'FINISHED'}
+
+
+class HQZWatch(bpy.types.Operator):
+    '''Re-export the current frame when the scene changes, rendering it
+    with few rays (Esc to stop)'''
+    bl_label = "Watch scene"
+    bl_idname = "render.hqz_watch"
+
+    # Shared with the scene update handler, None when not watching
+    state = None
+
+    def invoke(self, context, event):
+        if HQZWatch.state is not None:
+            # Already watching
+            HQZWatch.state.stop = True
+            return {'FINISHED'}
+        if not check_export(self, context):
+            return {'CANCELLED'}
+
+        HQZWatch.state = WatchState()
+        bpy.app.handlers.scene_update_post.append(watch_scene_update)
+
+        wm = context.window_manager
+        self.timer = wm.event_timer_add(0.05, context.window)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        state = HQZWatch.state
+        if event.type == 'ESC' or state.stop:
+            return self.finish(context)
+
+        if event.type == 'TIMER':
+            hqz_params = context.scene.hqz_parameters
+            if (state.changed is not None and
+                    time.time() - state.changed > hqz_params.watch_delay):
+                state.changed = None
+                self.export(context)
+            self.poll_render(context)
+
+        return {'PASS_THROUGH'}
+
+    def export(self, context):
+        '''Write the current frame, and start rendering it.'''
+        sc = context.scene
+        hqz_params = sc.hqz_parameters
+        targets = get_targets(sc, hqz_params)
+        state = HQZWatch.state
+
+        start = time.time()
+        frame_data = export_watched_frame(sc, hqz_params, targets, state)
+        for target, export_data in zip(targets, frame_data):
+            try:
+                write_frame(get_export_path(target.export_filepath,
+                                            sc.frame_current),
+                            export_data, hqz_params.debug)
+            except OSError as e:
+                self.report({'ERROR'}, str(e))
+        print('Exported frame {} in {:.2f}s'.format(sc.frame_current,
+                                                    time.time() - start))
+
+        if hqz_params.watch_render and hqz_params.hqz_bin_path:
+            self.start_render(bpy.path.abspath(hqz_params.hqz_bin_path),
+                              dict(frame_data[0],
+                                   rays=hqz_params.watch_rays))
+
+    def start_render(self, hqz_bin_path, export_data):
+        '''Render export data with hqz in the background, replacing the
+        render in progress, if any.'''
+        state = HQZWatch.state
+        if state.render is not None:
+            state.render.kill()
+            state.render.wait()
+        export_data.pop('timelimit', None)
+
+        image_path = os.path.join(bpy.app.tempdir, 'hqz_watch.png')
+        try:
+            state.render = subprocess.Popen(
+                [hqz_bin_path, '-', image_path], stdin=subprocess.PIPE)
+            state.render.stdin.write(json.dumps(export_data).encode())
+            state.render.stdin.close()
+        except OSError as e:
+            self.report({'ERROR'}, 'Could not run hqz: {}'.format(e))
+            state.render = None
+
+    def poll_render(self, context):
+        '''Show the background render once it is done.'''
+        state = HQZWatch.state
+        if state.render is None or state.render.poll() is None:
+            return
+        returncode = state.render.returncode
+        state.render = None
+        if returncode:
+            self.report({'WARNING'},
+                        'hqz failed with code {}.'.format(returncode))
+            return
+
+        image_path = os.path.join(bpy.app.tempdir, 'hqz_watch.png')
+        image = bpy.data.images.get('HQZ Watch')
+        if image is None:
+            image = bpy.data.images.load(image_path)
+            image.name = 'HQZ Watch'
+        else:
+            image.reload()
+        show_image(context, image)
+
+    def finish(self, context):
+        state = HQZWatch.state
+        if state.render is not None:
+            state.render.kill()
+            state.render.wait()
+        HQZWatch.state = None
+        bpy.app.handlers.scene_update_post.remove(watch_scene_update)
+        context.window_manager.event_timer_remove(self.timer)
+        return {'FINISHED'}
+
+
+class HQZMeshCacheClear(bpy.types.Operator):
+    '''Delete all evaluated meshes in the mesh cache'''
+    bl_label = "Clear mesh cache"
+    bl_idname = "render.hqz_mesh_cache_clear"
+
+    def execute(self, context):
+        mesh_cache = get_mesh_cache(context.scene.hqz_parameters)
+        if mesh_cache is not None:
+            mesh_cache.clear()
+        return {'FINISHED'}
+
+
+class HQZTargetAdd(bpy.types.Operator):
+    bl_label = "Add target"
+    bl_idname = "render.hqz_target_add"
+
+    def execute(self, context):
+        sc = context.scene
+        target = sc.hqz_parameters.targets.add()
+        if sc.camera is not None:
+            target.camera = sc.camera.name
+        target.resolution_percentage = sc.render.resolution_percentage
+        target.export_filepath = sc.hqz_parameters.export_filepath
+        return {'FINISHED'}
+
+
+class HQZTargetDelete(bpy.types.Operator):
+    bl_label = "Delete target"
+    bl_idname = "render.hqz_target_delete"
+
+    index = bpy.props.IntProperty()
+
+    def execute(self, context):
+        context.scene.hqz_parameters.targets.remove(self.index)
+        return {'FINISHED'}
+
 
 class HQZMaterialAdd(bpy.types.Operator):
     bl_label = "Export scene"
@@ -364,6 +1439,14 @@ class HQZ_Materials_List(bpy.types.UIList):
                     emboss=False, translate=False, icon="MATERIAL")
 
 
+class HQZ_Targets_List(bpy.types.UIList):
+    def draw_item(self, context, layout, data, item,
+                  icon, active_data, active_propname, index):
+        layout.label(text="{} ({}%)".format(item.camera,
+                                            item.resolution_percentage),
+                     translate=False, icon="CAMERA_DATA")
+
+
 class HQZMaterialPanel(bpy.types.Panel):
     bl_label = "HQZ Material"
     bl_space_type = 'PROPERTIES'
@@ -460,6 +1543,13 @@ class HQZExportPanel(bpy.types.Panel):
         col.label(text="Stopping conditions:")
         col.prop(hqz_params, "rays")
         col.prop(hqz_params, "time")
+        col.prop(hqz_params, "sub_jobs")
+
+        col.prop(hqz_params, "use_adaptive_rays")
+        sub = col.column(align=True)
+        sub.active = hqz_params.use_adaptive_rays
+        sub.prop(hqz_params, "adaptive_noise")
+        sub.prop(hqz_params, "adaptive_pilot_rays")
 
         layout.separator()
         split = layout.split()
@@ -472,10 +1562,65 @@ class HQZExportPanel(bpy.types.Panel):
         col = split.column()
         col.prop(hqz_params, "animation")
 
+        split = layout.split()
+        col = split.column()
+        col.prop(hqz_params, "cull_unreachable")
+
+        col = split.column()
+        col.active = hqz_params.cull_unreachable
+        col.prop(hqz_params, "cull_probes")
+
+        split = layout.split()
+        col = split.column(align=True)
+        col.prop(hqz_params, "use_mesh_cache")
+        sub = col.column()
+        sub.active = hqz_params.use_mesh_cache
+        sub.operator("render.hqz_mesh_cache_clear")
+
+        col = split.column(align=True)
+        col.active = hqz_params.use_mesh_cache
+        col.prop(hqz_params, "mesh_cache_dir", text="")
+        col.prop(hqz_params, "mesh_cache_size")
+
+        layout.separator()
         col = layout.column()
+        col.prop(hqz_params, "use_targets")
+        if hqz_params.use_targets:
+            row = col.row()
+            row.template_list("HQZ_Targets_List", "",
+                              hqz_params, "targets",
+                              hqz_params, "active_target", rows=2)
+            sub = row.column(align=True)
+            sub.operator("render.hqz_target_add", icon='ZOOMIN', text="")
+            op = sub.operator("render.hqz_target_delete",
+                              icon='ZOOMOUT', text="")
+            op.index = hqz_params.active_target
+
+            if hqz_params.active_target < len(hqz_params.targets):
+                target = hqz_params.targets[hqz_params.active_target]
+                col.prop_search(target, "camera", context.scene, "objects")
+                col.prop(target, "resolution_percentage")
+                col.prop(target, "export_filepath")
+
         col = layout.column()
+        row = col.row(align=True)
+        row.operator("render.hqz_preview", text="Preview lighting")
+        row.prop(hqz_params, "preview_rays", text="Rays")
         col.operator("render.hqz_export", text="Export scene")
 
+        row = col.row(align=True)
+        if HQZWatch.state is None:
+            row.operator("render.hqz_watch", text="Watch scene",
+                         icon='PLAY')
+        else:
+            row.operator("render.hqz_watch", text="Stop watching",
+                         icon='PAUSE')
+        row.prop(hqz_params, "watch_render", text="Render")
+        sub = row.row(align=True)
+        sub.active = hqz_params.watch_render
+        sub.prop(hqz_params, "watch_rays", text="Rays")
+        row.prop(hqz_params, "watch_delay", text="Delay")
+
 
 class HQZLamp(bpy.types.PropertyGroup):
     light_start = bpy.props.FloatProperty(
@@ -500,8 +1645,31 @@ class HQZMaterial(bpy.types.PropertyGroup):
                                            min=0.0, max=1.0)
 
 
+class HQZTarget(bpy.types.PropertyGroup):
+    camera = bpy.props.StringProperty(
+        name="Camera",
+        description="Camera to export the scene from")
+    resolution_percentage = bpy.props.IntProperty(
+        name="Resolution",
+        description="Percentage scale for render resolution",
+        subtype='PERCENTAGE',
+        default=100,
+        min=1)
+    export_filepath = bpy.props.StringProperty(
+        name="Export filepath",
+        description="Path where the hqz json file will be exported",
+        subtype="FILE_PATH")
+
+
 class HQZParameters(bpy.types.PropertyGroup):
     materials = bpy.props.CollectionProperty(type=HQZMaterial)
+    targets = bpy.props.CollectionProperty(type=HQZTarget)
+    active_target = bpy.props.IntProperty()
+    use_targets = bpy.props.BoolProperty(
+        name="Export targets",
+        description=("Export the scene for several cameras and resolutions, "
+                     "evaluating objects only once per frame"),
+        default=False)
     hqz_bin_path = bpy.props.StringProperty(
         name="hqz binary path",
         description="Path to the hqz binary",
@@ -541,6 +1709,31 @@ class HQZParameters(bpy.types.PropertyGroup):
         description="Time before render is cancelled (0 for infinity)",
         default=0,
         min=0)
+    use_adaptive_rays = bpy.props.BoolProperty(
+        name="Adaptive rays",
+        description="Choose the number of rays of each frame from a pilot "
+                    "render, for the same noise in all frames. The number "
+                    "of rays is then a maximum",
+        default=False)
+    adaptive_noise = bpy.props.FloatProperty(
+        name="Target noise",
+        description="Noise to reach in each frame, as a fraction of "
+                    "full brightness",
+        default=0.02,
+        min=0.001,
+        max=1.0)
+    adaptive_pilot_rays = bpy.props.IntProperty(
+        name="Pilot rays",
+        description="Number of rays of the pilot render of each frame, "
+                    "and minimum number of rays",
+        default=4000,
+        min=100)
+    sub_jobs = bpy.props.IntProperty(
+        name="Split frames",
+        description="Number of sub-jobs each frame is split into, "
+                    "rendered with different seeds and merged with merge.py",
+        default=1,
+        min=1)
     animation = bpy.props.BoolProperty(
         name="Export animation",
         description="Export a file for each frame in Blender's frame range",
@@ -552,6 +1745,53 @@ class HQZParameters(bpy.types.PropertyGroup):
     normals_invert = bpy.props.BoolProperty(
         name="Invert normals",
         default=False)
+    cull_unreachable = bpy.props.BoolProperty(
+        name="Cull unreachable",
+        description="Remove segments which no light can reach, "
+                    "found by tracing probe rays from each light",
+        default=False)
+    cull_probes = bpy.props.IntProperty(
+        name="Probe rays",
+        description="Number of probe rays traced from each light",
+        default=1000,
+        min=1)
+    use_mesh_cache = bpy.props.BoolProperty(
+        name="Mesh cache",
+        description="Store evaluated meshes on disk, and reuse them in "
+                    "later exports if their object didn't change",
+        default=False)
+    mesh_cache_dir = bpy.props.StringProperty(
+        name="Mesh cache directory",
+        description="Directory where evaluated meshes are stored",
+        default="//hqz_cache/",
+        subtype="DIR_PATH")
+    mesh_cache_size = bpy.props.IntProperty(
+        name="Cache size (MB)",
+        description="Size of the mesh cache, above which the least "
+                    "recently used meshes are deleted",
+        default=1000,
+        min=1)
+    watch_render = bpy.props.BoolProperty(
+        name="Render watched scene",
+        description="Render the watched frame with hqz after each export, "
+                    "and show it in the HQZ Watch image",
+        default=True)
+    watch_rays = bpy.props.IntProperty(
+        name="Watch rays",
+        description="Number of rays of the watched frame's render",
+        default=20000,
+        min=1)
+    watch_delay = bpy.props.FloatProperty(
+        name="Watch delay",
+        description="Time without changes before the watched frame is "
+                    "exported again, in seconds",
+        default=0.3,
+        min=0.0)
+    preview_rays = bpy.props.IntProperty(
+        name="Preview rays",
+        description="Number of rays traced for the lighting preview",
+        default=10000,
+        min=1)
     debug = bpy.props.BoolProperty(
         name="Debug",
         description="Remove all newlines, to read json with wireframe.html",
@@ -561,17 +1801,24 @@ class HQZParameters(bpy.types.PropertyGroup):
 def register():
     bpy.utils.register_class(HQZMaterial)
     bpy.utils.register_class(HQZLamp)
+    bpy.utils.register_class(HQZTarget)
     bpy.utils.register_class(HQZParameters)
     bpy.types.Scene.hqz_parameters = bpy.props.PointerProperty(
         type=HQZParameters)
     bpy.types.Lamp.hqz_lamp = bpy.props.PointerProperty(type=HQZLamp)
     bpy.utils.register_class(HQZ_Materials_List)
+    bpy.utils.register_class(HQZ_Targets_List)
     bpy.utils.register_class(HQZExport)
+    bpy.utils.register_class(HQZPreview)
+    bpy.utils.register_class(HQZWatch)
     bpy.utils.register_class(HQZMaterialPanel)
     bpy.utils.register_class(HQZLampPanel)
     bpy.utils.register_class(HQZExportPanel)
     bpy.utils.register_class(HQZMaterialAdd)
     bpy.utils.register_class(HQZMaterialDelete)
+    bpy.utils.register_class(HQZTargetAdd)
+    bpy.utils.register_class(HQZTargetDelete)
+    bpy.utils.register_class(HQZMeshCacheClear)
     bpy.types.Object.hqz_material_id = bpy.props.IntProperty(
         name='HQZ Material')
 
@@ -580,14 +1827,21 @@ def unregister():
     bpy.utils.unregister_class(HQZParameters)
     del bpy.types.Scene.hqz_parameters
     bpy.utils.unregister_class(HQZ_Materials_List)
+    bpy.utils.unregister_class(HQZ_Targets_List)
+    bpy.utils.unregister_class(HQZTarget)
     bpy.utils.unregister_class(HQZMaterial)
     bpy.utils.unregister_class(HQZLamp)
     bpy.utils.unregister_class(HQZExport)
+    bpy.utils.unregister_class(HQZPreview)
+    bpy.utils.unregister_class(HQZWatch)
     bpy.utils.unregister_class(HQZMaterialPanel)
     bpy.utils.unregister_class(HQZLampPanel)
     bpy.utils.unregister_class(HQZExportPanel)
     bpy.utils.unregister_class(HQZMaterialAdd)
     bpy.utils.unregister_class(HQZMaterialDelete)
+    bpy.utils.unregister_class(HQZTargetAdd)
+    bpy.utils.unregister_class(HQZTargetDelete)
+    bpy.utils.unregister_class(HQZMeshCacheClear)
     del bpy.types.Scene.hqz_material_id
     del bpy.types.Scene.hqz_lamp
 
@@ -0,0 +1,133 @@
+####### hqz exporter for Blender ##############
+#
+#   © Damien Picard 2014-2018
+#
+#	HQZ by Micah Elizabeth Scott - scanlime.org
+#
+###############################################
+
+'''Choose the number of rays of each frame for a uniform noise level.
+
+A pilot render of each frame is traced twice at low resolution with
+the preview tracer, with different seeds. The difference between both
+renders measures the relative noise of their mean in linear light,
+which is converted to display values from 0 to 1 and averaged over the
+visible pixels. Monte Carlo noise decreases with the square root of the
+number of rays. Each ray draws lines, which cross a number of pixels
+proportional to the resolution, so noise increases with the square root
+of the resolution. This gives the number of rays reaching the target
+noise at full resolution. It is an estimate, which tends to be a little
+low.
+
+This module is also imported by local_runner.py, outside of Blender, to
+format render times.
+'''
+
+import json
+import os
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+try:
+    from . import preview
+except ImportError:
+    # Imported from the add-on directory, outside of Blender
+    import preview
+
+
+# Resolution scale of pilot renders
+PILOT_SCALE = 0.25
+
+# Pixels darker than this are not counted in the noise measure
+VISIBLE = 1.0 / 255.0
+
+# Number of rays traced by hqz to measure its speed
+CALIBRATION_RAYS = 20000
+
+# Rays traced at once by pilot renders
+PILOT_BATCH = 5000
+
+
+def iter_measure_noise(export_data, rays, scale=PILOT_SCALE):
+    '''Measure the noise of a pilot render of rays rays, at the resolution
+    multiplied by scale.
+
+    Rays are traced in batches. This generator yields the fraction of
+    rays traced after each batch, and returns the RMS noise of visible
+    pixels, in display values.'''
+    seed = export_data.get('seed', 0)
+    pilots = [preview.Preview(export_data, scale, pilot_seed)
+              for pilot_seed in (seed, seed + 1)]
+    per_pilot = max(rays // 2, 1)
+    for pilot_i, pilot in enumerate(pilots):
+        while pilot.lights and pilot.rays < per_pilot:
+            pilot.trace(min(PILOT_BATCH, per_pilot - pilot.rays))
+            yield (pilot_i + pilot.rays / per_pilot) / len(pilots)
+
+    # Relative noise of the mean of both renders' intensity, in linear
+    # light
+    first, second = (pilot.histogram.sum(axis=0) for pilot in pilots)
+    mean = (first + second) / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        relative = np.abs(first - second) / 2 / mean
+
+    # Gamma correction scales relative noise by 1 / gamma. Saturated
+    # pixels show no noise.
+    gamma = export_data.get('gamma', 0) or 1.0
+    display = (pilots[0].display() + pilots[1].display()).mean(axis=2) / 2
+    visible = (display > VISIBLE) & (display < 1.0) & (mean > 0)
+    if not visible.any():
+        return 0.0
+    noise = display[visible] * relative[visible] / gamma
+    return float(np.sqrt(np.mean(noise ** 2)))
+
+
+def iter_choose_rays(export_data, target_noise, pilot_rays, max_rays,
+                     scale=PILOT_SCALE):
+    '''Get the number of rays for export data to reach the target noise,
+    at least pilot_rays, and at most max_rays unless it is 0.
+
+    This generator yields the fraction of the pilot render done, and
+    returns the number of rays.'''
+    noise = yield from iter_measure_noise(export_data, pilot_rays, scale)
+    rays = max(pilot_rays * (noise / target_noise) ** 2 / scale, pilot_rays)
+    if max_rays:
+        rays = min(rays, max_rays)
+    return int(rays)
+
+
+def time_render(hqz_bin_path, export_data):
+    '''Render export data with hqz, returning the time it took, or None
+    if hqz can't be run.'''
+    directory = tempfile.mkdtemp()
+    scene_path = os.path.join(directory, 'calibration.json')
+    image_path = os.path.join(directory, 'calibration.png')
+    try:
+        with open(scene_path, 'w') as f:
+            json.dump(export_data, f)
+        start = time.time()
+        returncode = subprocess.call([hqz_bin_path, scene_path, image_path],
+                                     stdout=subprocess.DEVNULL,
+                                     stderr=subprocess.DEVNULL)
+        elapsed = time.time() - start
+    except OSError:
+        return None
+    finally:
+        for path in (scene_path, image_path):
+            if os.path.exists(path):
+                os.remove(path)
+        os.rmdir(directory)
+
+    if returncode:
+        return None
+    return elapsed
+
+
+def format_duration(seconds):
+    '''Format a duration in seconds as hours, minutes and seconds.'''
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02}:{:02}'.format(hours, minutes, seconds)
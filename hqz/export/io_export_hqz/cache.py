@@ -0,0 +1,122 @@
+####### hqz exporter for Blender ##############
+#
+#   © Damien Picard 2014-2018
+#
+#	HQZ by Micah Elizabeth Scott - scanlime.org
+#
+###############################################
+
+'''Cache evaluated meshes on disk, across export sessions.
+
+Evaluating objects with heavy modifier stacks is often the slowest part
+of an export, and most objects don't change between two exports. Each
+entry holds the world space edges of an evaluated object, as a .npy
+file named after a hash of everything the evaluation depends on, so
+that changed objects simply miss the cache.
+
+Entries are loaded memory-mapped. When the cache grows over its size
+limit, the least recently used entries are deleted. Using an entry
+updates its modification time, which is shared by every Blender session
+using the same directory.
+'''
+
+import hashlib
+import os
+
+import numpy as np
+
+
+class MeshCache:
+    '''Arrays stored in a directory, by key.'''
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(size for _, size, _ in self.entries())
+
+    def path(self, key):
+        '''Get the file of an entry. Keys are any value with a stable
+        repr, like tuples of strings and numbers.'''
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.directory, digest + '.npy')
+
+    def entries(self):
+        '''Get the path, size and last use of all entries.'''
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npy'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Deleted by another session
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def get(self, key):
+        '''Get the array of a key, memory-mapped, or None.'''
+        path = self.path(key)
+        try:
+            array = np.load(path, mmap_mode='r')
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return array
+
+    def put(self, key, array):
+        '''Store the array of a key, evicting old entries if the cache
+        is full.'''
+        path = self.path(key)
+        # Write atomically, for other sessions reading the same entry
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(temp_path, 'wb') as f:
+                np.save(f, array)
+            size = os.path.getsize(temp_path)
+            # An entry replaced with another array doesn't grow the cache
+            old_size = (os.path.getsize(path) if os.path.exists(path)
+                        else 0)
+            os.replace(temp_path, path)
+        except OSError:
+            # The entry is mapped by another session on Windows, or the
+            # disk is full
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+        self.size += size - old_size
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        '''Delete least recently used entries until the cache is at most
+        three quarters full, so that it isn't evicted at every put.'''
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        self.size = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if self.size <= self.max_size * 3 // 4:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+
+    def clear(self):
+        '''Delete all entries.'''
+        for path, _, _ in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.size = 0
+
+    def __str__(self):
+        return 'Mesh cache: {} hits, {} misses, {:.1f} MB'.format(
+            self.hits, self.misses, self.size / 1e6)
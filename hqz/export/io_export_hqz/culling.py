@@ -0,0 +1,148 @@
+####### hqz exporter for Blender ##############
+#
+#   © Damien Picard 2014-2018
+#
+#	HQZ by Micah Elizabeth Scott - scanlime.org
+#
+###############################################
+
+'''Cull exported segments which no light can reach.
+
+Probe rays are shot from each light and traced through the scene. At
+each hit, a probe takes any outcome its material allows, whatever its
+weight, so that it follows every path light could take through
+transmissive and reflective segments. Segments which are never hit
+don't change the render, but still cost hqz a tree traversal.
+
+Culling is conservative: segments are only culled if no probe traversed
+the tree node holding them, so that segments close to reached ones are
+kept even if probes happened to miss them. Culling only the segments no
+probe hit removes lit segments, even with thousands of probes per light.
+Segments with random values, like a range of positions, and malformed
+segments are never culled.
+'''
+
+from collections import namedtuple
+
+import numpy as np
+
+from . import preview
+
+
+# Probe rays traced from each light at once
+PROBE_BATCH = 250
+
+
+class CullReport(namedtuple('CullReport', ('segments', 'culled',
+                                           'probes', 'warnings'))):
+    '''Number of segments before culling and culled, and warnings
+    about malformed lights and segments.'''
+
+    def __str__(self):
+        return '; '.join(
+            ['Culled {} of {} segments ({:.0%}), {} probe rays per light'
+             .format(self.culled, self.segments,
+                     self.culled / max(self.segments, 1), self.probes)]
+            + list(self.warnings))
+
+
+class Probe(preview.Tracer):
+    '''Trace probe rays, recording the segments and tree nodes they
+    reach.'''
+
+    def __init__(self, scene, seed=None):
+        super().__init__(scene, seed)
+        self.hit = np.zeros(len(self.material), dtype=bool)
+        self.visited = np.zeros(len(self.tree.obj_count), dtype=bool)
+
+        # Outcomes of each material which don't absorb light
+        weight = np.diff(self.outcome_weight, axis=1, prepend=0.0)
+        self.possible = (weight > 0) & (self.outcome_type != preview.ABSORB)
+
+    def choose_outcomes(self, obj):
+        '''Choose any outcome the segments' materials allow.'''
+        possible = self.possible[self.material[obj]]
+        count = possible.sum(axis=1)
+        r = np.floor(self.rng.uniform(size=len(obj)) * count)
+        choice = (np.cumsum(possible, axis=1) <= r[:, None]).sum(axis=1)
+        choice = np.minimum(choice, possible.shape[1] - 1)
+        outcome = self.outcome_type[self.material[obj], choice]
+        outcome[count == 0] = preview.ABSORB
+        return outcome
+
+    def probe(self, rays_per_light, bounces):
+        '''Trace rays_per_light rays from each light.'''
+        ox, oy, dx, dy, color = self.emit(
+            np.repeat(np.arange(len(self.lights)), rays_per_light))
+        last = np.full(len(ox), -1, dtype=np.int64)
+
+        for bounce in range(bounces):
+            if not len(ox):
+                break
+
+            t, obj, u = self.tree.intersect(ox, oy, dx, dy, last,
+                                            self.visited)
+            hit = obj >= 0
+            ox, oy, dx, dy, obj, u, t = (
+                a[hit] for a in (ox, oy, dx, dy, obj, u, t))
+            self.hit[obj] = True
+            px = ox + t * dx
+            py = oy + t * dy
+
+            outcome = self.choose_outcomes(obj)
+            self.scatter(obj, u, dx, dy, outcome)
+
+            alive = outcome != preview.ABSORB
+            ox, oy, dx, dy, last = (
+                a[alive] for a in (px, py, dx, dy, obj))
+
+    def reached(self):
+        '''Get which segments are in tree nodes probes traversed.'''
+        tree = self.tree
+        node = np.repeat(np.arange(len(tree.obj_count)), tree.obj_count)
+        reached = self.hit.copy()
+        reached[tree.obj_index[self.visited[node]]] = True
+        return reached
+
+
+def iter_cull_unreachable(export_data, probes=1000, bounces=32):
+    '''Remove segments no probe ray reaches from export data.
+
+    probes rays are traced from each light, for up to bounces bounces,
+    in batches. This generator yields the fraction of probes traced
+    after each batch, and returns a CullReport.'''
+    objects = export_data['objects']
+    report = CullReport(len(objects), 0, probes, ())
+    if not objects or not export_data['lights']:
+        return report
+
+    probe = Probe(export_data)
+    report = report._replace(warnings=tuple(probe.warnings))
+    if not probe.lights:
+        return report
+    traced = 0
+    while traced < probes:
+        batch = min(PROBE_BATCH, probes - traced)
+        probe.probe(batch, bounces)
+        traced += batch
+        yield traced / probes
+
+    keep = probe.reached() | probe.invalid
+    for i, obj in enumerate(objects):
+        if not keep[i] and any(isinstance(value, list)
+                               for value in obj[1:]):
+            keep[i] = True
+
+    export_data['objects'] = [obj for obj, k in zip(objects, keep) if k]
+    return report._replace(culled=len(objects) - int(keep.sum()))
+
+
+def cull_unreachable(export_data, probes=1000, bounces=32):
+    '''Remove segments no probe ray reaches from export data, at once.
+    Returns a CullReport.'''
+    steps = iter_cull_unreachable(export_data, probes, bounces)
+    while True:
+        try:
+            next(steps)
+        except StopIteration as done:
+            return done.value
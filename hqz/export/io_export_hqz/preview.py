@@ -0,0 +1,649 @@
+####### hqz exporter for Blender ##############
+#
+#   © Damien Picard 2014-2018
+#
+#	HQZ by Micah Elizabeth Scott - scanlime.org
+#
+###############################################
+
+'''Quick lighting preview of hqz scenes, traced with NumPy.
+
+Rays are traced in batches, as arrays, following the rules of hqz:
+lights are chosen according to their power, and "d", "t" and "r"
+material outcomes are chosen according to their weights. Segments with
+interpolated normals are supported. Segments are looked up in a tree
+built like hqz's ZQuadtree.
+
+This is a preview: random variables in objects are sampled once per
+render instead of once per ray, and lines are drawn with simple
+antialiasing. Exposure and gamma match hqz.
+
+This module does not depend on bpy, and may be run on an exported
+file: python preview.py scene.json preview.png [rays [scale]]
+'''
+
+import json
+import struct
+import sys
+import zlib
+
+import numpy as np
+
+
+# Split threshold for number of objects in one tree node, as in hqz
+SPLIT_THRESHOLD = 16
+MAX_DEPTH = 32
+MAX_BOUNCES = 1000
+
+# Maximum number of line samples drawn at once
+DRAW_CHUNK = 1 << 22
+
+# Material outcomes
+ABSORB, DIFFUSE, TRANSMIT, REFLECT = range(4)
+OUTCOMES = {'d': DIFFUSE, 't': TRANSMIT, 'r': REFLECT}
+
+
+# SAMPLED VALUES
+
+def blackbody_wavelengths(temperature, n, rng):
+    '''Sample n wavelengths in nm emitted by a blackbody, by rejection.'''
+    h, c, k = 6.626e-34, 2.998e8, 1.381e-23
+    nm = np.linspace(360.0, 780.0, 421)
+    radiance = 1.0 / (nm ** 5 * np.expm1(h * c / (nm * 1e-9 * k * temperature)))
+    peak = radiance.max()
+
+    result = np.empty(n)
+    todo = np.arange(n)
+    while len(todo):
+        candidates = rng.uniform(360.0, 780.0, len(todo))
+        accept = (rng.uniform(0.0, peak, len(todo))
+                  <= np.interp(candidates, nm, radiance))
+        result[todo[accept]] = candidates[accept]
+        todo = todo[~accept]
+    return result
+
+
+def sample(value, n, rng):
+    '''Sample a hqz random variable n times.'''
+    if isinstance(value, (int, float)):
+        return np.full(n, float(value))
+    if isinstance(value, list) and len(value) == 2:
+        if all(isinstance(v, (int, float)) for v in value):
+            return rng.uniform(value[0], value[1], n)
+        if value[1] == 'K':
+            return blackbody_wavelengths(value[0], n, rng)
+    # Unknown
+    return np.zeros(n)
+
+
+def mean_value(value):
+    '''Get the mean of a hqz random variable.'''
+    if isinstance(value, (int, float)):
+        return float(value)
+    if (isinstance(value, list) and len(value) == 2
+            and all(isinstance(v, (int, float)) for v in value)):
+        return (value[0] + value[1]) / 2.0
+    return 0.0
+
+
+def wavelength_to_rgb(nm):
+    '''Convert wavelengths to linear sRGB colors, scaled like hqz.
+
+    Uses the analytic approximation of the CIE 1931 color matching
+    functions by Wyman, Sloan and Shirley. Zero is white light, and
+    wavelengths outside of 360-780nm are invisible.'''
+    def lobe(mu, sigma1, sigma2):
+        sigma = np.where(nm < mu, sigma1, sigma2)
+        return np.exp(-0.5 * ((nm - mu) / sigma) ** 2)
+
+    x = (1.056 * lobe(599.8, 37.9, 31.0) + 0.362 * lobe(442.0, 16.0, 26.7)
+         - 0.065 * lobe(501.1, 20.4, 26.2))
+    y = 0.821 * lobe(568.8, 46.9, 40.5) + 0.286 * lobe(530.9, 16.3, 31.1)
+    z = 1.217 * lobe(437.0, 11.8, 36.0) + 0.681 * lobe(459.0, 26.0, 13.8)
+
+    xyz_to_rgb = np.array([[3.2406, -1.5372, -0.4986],
+                           [-0.9689, 1.8758, 0.0415],
+                           [0.0557, -0.2040, 1.0570]])
+    rgb = 8192.0 * np.stack((x, y, z), axis=-1).dot(xyz_to_rgb.T)
+    rgb[(nm < 360) | (nm > 780)] = 0.0
+    rgb[nm == 0] = 8192.0
+    return rgb
+
+
+# SPATIAL INDEX
+
+class SegmentTree:
+    '''Binary space partition of segments, built like hqz's ZQuadtree.
+
+    Each node splits space at the mean of its objects' bounding box
+    centers, alternating axes. Objects which don't fit in either child
+    stay in the node. Rays are traversed breadth first, all at once.'''
+
+    def __init__(self, x0, y0, dx, dy):
+        self.x0, self.y0, self.dx, self.dy = x0, y0, dx, dy
+        bounds = np.stack((np.minimum(x0, x0 + dx), np.minimum(y0, y0 + dy),
+                           np.maximum(x0, x0 + dx), np.maximum(y0, y0 + dy)),
+                          axis=1)
+
+        # Node bounds (left, top, right, bottom), children and objects
+        node_bounds = []
+        children = []
+        node_objects = []
+
+        inf = np.inf
+        stack = [(np.arange(len(x0)), (-inf, -inf, inf, inf), False, 0, -1, 0)]
+        while stack:
+            objects, box, axis_y, depth, parent, side = stack.pop()
+            index = len(node_bounds)
+            node_bounds.append(box)
+            children.append([-1, -1])
+            if parent >= 0:
+                children[parent][side] = index
+
+            if len(objects) <= SPLIT_THRESHOLD or depth >= MAX_DEPTH:
+                node_objects.append(objects)
+                continue
+
+            axis = 1 if axis_y else 0
+            obj_bounds = bounds[objects]
+            split = (obj_bounds[:, axis] + obj_bounds[:, axis + 2]).mean() / 2
+            first = obj_bounds[:, axis + 2] <= split
+            second = ~first & (obj_bounds[:, axis] >= split)
+            if not first.any() and not second.any():
+                node_objects.append(objects)
+                continue
+
+            node_objects.append(objects[~first & ~second])
+            first_box, second_box = list(box), list(box)
+            first_box[axis + 2] = split
+            second_box[axis] = split
+            stack.append((objects[second], tuple(second_box),
+                          not axis_y, depth + 1, index, 1))
+            stack.append((objects[first], tuple(first_box),
+                          not axis_y, depth + 1, index, 0))
+
+        self.node_bounds = np.array(node_bounds, dtype=float)
+        self.children = np.array(children, dtype=np.int64)
+        self.obj_count = np.array([len(o) for o in node_objects],
+                                  dtype=np.int64)
+        self.obj_start = np.concatenate(([0], np.cumsum(self.obj_count)[:-1]))
+        self.obj_index = (np.concatenate(node_objects).astype(np.int64)
+                          if node_objects else np.zeros(0, dtype=np.int64))
+
+    def intersect(self, ox, oy, dx, dy, exclude, visited=None):
+        '''Find the closest segment hit by each ray.
+
+        Returns the distance, segment index (-1 for no hit) and position
+        along the segment of each hit. The exclude segment of each ray,
+        usually the one it starts from, is never hit. If visited is a
+        boolean array, nodes traversed by any ray are set in it.'''
+        n = len(ox)
+        best_t = np.full(n, np.inf)
+        best_obj = np.full(n, -1, dtype=np.int64)
+        best_u = np.zeros(n)
+
+        rays = np.arange(n)
+        nodes = np.zeros(n, dtype=np.int64)
+        while len(rays):
+            if visited is not None:
+                visited[nodes] = True
+
+            # Local objects of each (ray, node) pair
+            count = self.obj_count[nodes]
+            total = count.sum()
+            if total:
+                pair_rays = np.repeat(rays, count)
+                first = np.repeat(np.cumsum(count) - count, count)
+                positions = (np.repeat(self.obj_start[nodes], count)
+                             + np.arange(total) - first)
+                objs = self.obj_index[positions]
+
+                t, u = segment_intersection(
+                    ox[pair_rays], oy[pair_rays],
+                    dx[pair_rays], dy[pair_rays],
+                    self.x0[objs], self.y0[objs],
+                    self.dx[objs], self.dy[objs])
+                hit = ((objs != exclude[pair_rays])
+                       & (t < best_t[pair_rays]))
+                pair_rays, objs, t, u = (pair_rays[hit], objs[hit],
+                                         t[hit], u[hit])
+
+                # Keep the closest hit of each ray
+                order = np.lexsort((t, pair_rays))
+                closest = order[np.unique(pair_rays[order],
+                                          return_index=True)[1]]
+                hit_rays = pair_rays[closest]
+                best_t[hit_rays] = t[closest]
+                best_obj[hit_rays] = objs[closest]
+                best_u[hit_rays] = u[closest]
+
+            # Visit children whose bounds the ray enters before its
+            # closest hit so far
+            next_rays, next_nodes = [], []
+            for side in (0, 1):
+                child = self.children[nodes, side]
+                valid = child >= 0
+                child_rays, child = rays[valid], child[valid]
+                box = self.node_bounds[child]
+                enter, leave = box_intersection(
+                    ox[child_rays], oy[child_rays],
+                    dx[child_rays], dy[child_rays], box)
+                visit = (leave >= np.maximum(enter, 0.0)) & (
+                    enter < best_t[child_rays])
+                next_rays.append(child_rays[visit])
+                next_nodes.append(child[visit])
+            rays = np.concatenate(next_rays)
+            nodes = np.concatenate(next_nodes)
+
+        return best_t, best_obj, best_u
+
+
+def segment_intersection(ox, oy, dx, dy, sx, sy, sdx, sdy):
+    '''Intersect rays with segments.
+
+    Returns the distance along each ray, infinite if there is no hit, and
+    the position of the hit along each segment, from 0 to 1.'''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        denom = dx * sdy - dy * sdx
+        wx = sx - ox
+        wy = sy - oy
+        t = (wx * sdy - wy * sdx) / denom
+        u = (wx * dy - wy * dx) / denom
+    hit = (denom != 0) & (t > 1e-9) & (u >= 0.0) & (u <= 1.0)
+    return np.where(hit, t, np.inf), u
+
+
+def box_intersection(ox, oy, dx, dy, box):
+    '''Get the distances where rays enter and leave boxes.
+
+    Boxes are (left, top, right, bottom) rows. Rays which miss their box
+    leave it before entering it.'''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inv_x = 1.0 / dx
+        inv_y = 1.0 / dy
+        tx1 = (box[:, 0] - ox) * inv_x
+        tx2 = (box[:, 2] - ox) * inv_x
+        ty1 = (box[:, 1] - oy) * inv_y
+        ty2 = (box[:, 3] - oy) * inv_y
+    enter = np.maximum(np.fmin(tx1, tx2), np.fmin(ty1, ty2))
+    leave = np.minimum(np.fmax(tx1, tx2), np.fmax(ty1, ty2))
+    return enter, leave
+
+
+# TRACING
+
+class Tracer:
+    '''Lights, segments and materials of a hqz scene, ready to trace.'''
+
+    def __init__(self, scene, seed=None):
+        self.scene = scene
+        seed = scene.get('seed', 0) if seed is None else seed
+        self.rng = np.random.RandomState(seed & 0xffffffff)
+        self.viewport = [mean_value(v) for v in scene['viewport']]
+
+        # Malformed entries are skipped, with a warning, as hqz would
+        # fail on them
+        self.warnings = []
+        self.lights = [light for light in scene['lights']
+                       if isinstance(light, list) and len(light) >= 7]
+        skipped = len(scene['lights']) - len(self.lights)
+        if skipped:
+            self.warnings.append(
+                'Skipped {} lights with fewer than 7 values'.format(skipped))
+        power = np.array([mean_value(light[0]) for light in self.lights])
+        self.light_power = power.sum()
+        if self.lights and self.light_power <= 0:
+            self.warnings.append('Lights have no power')
+            self.lights = []
+        self.light_probability = power / max(self.light_power, 1e-300)
+
+        self.init_materials(scene['materials'])
+        self.init_objects(scene['objects'])
+
+    def init_objects(self, objects):
+        # Random variables in objects are sampled once per preview
+        n = len(objects)
+        x0, y0, dx, dy = (np.zeros(n) for i in range(4))
+        self.angle = np.zeros(n)
+        self.angle_delta = np.zeros(n)
+        self.interpolated = np.zeros(n, dtype=bool)
+        self.material = np.zeros(n, dtype=np.int64)
+        self.invalid = np.zeros(n, dtype=bool)
+        absorber = len(self.outcome_weight) - 1
+
+        for i, obj in enumerate(objects):
+            if not isinstance(obj, list) or len(obj) not in (5, 7):
+                # Left as a point, which nothing hits
+                self.invalid[i] = True
+                continue
+            material = obj[0]
+            if (isinstance(material, int) and not isinstance(material, bool)
+                    and 0 <= material < absorber):
+                self.material[i] = material
+            else:
+                self.material[i] = absorber
+                self.invalid[i] = True
+            values = [sample(v, 1, self.rng)[0] for v in obj[1:]]
+            if len(obj) == 7:
+                x0[i], y0[i], self.angle[i], dx[i], dy[i], \
+                    self.angle_delta[i] = values
+                self.interpolated[i] = True
+            else:
+                x0[i], y0[i], dx[i], dy[i] = values
+
+        invalid = int(self.invalid.sum())
+        if invalid:
+            self.warnings.append(
+                '{} segments have no valid material or size, and absorb '
+                'light'.format(invalid))
+        self.tree = SegmentTree(x0, y0, dx, dy)
+
+    def init_materials(self, materials):
+        # Cumulative outcome weights, padded with absorption. An extra
+        # last material absorbs everything, for segments without a
+        # valid one.
+        size = max([len(m) for m in materials if isinstance(m, list)] + [1])
+        self.outcome_weight = np.zeros((len(materials) + 1, size))
+        self.outcome_type = np.full((len(materials) + 1, size), ABSORB)
+        skipped = 0
+        for i, material in enumerate(materials):
+            if not isinstance(material, list):
+                skipped += 1
+                continue
+            for j, outcome in enumerate(material):
+                if (not isinstance(outcome, list) or len(outcome) != 2
+                        or not isinstance(outcome[0], (int, float))):
+                    skipped += 1
+                    continue
+                weight, kind = outcome
+                self.outcome_weight[i, j] = weight
+                if isinstance(kind, str):
+                    self.outcome_type[i, j] = OUTCOMES.get(kind, ABSORB)
+        if skipped:
+            self.warnings.append(
+                'Skipped {} malformed material outcomes'.format(skipped))
+        self.outcome_weight = np.cumsum(self.outcome_weight, axis=1)
+
+    def init_rays(self, n):
+        '''Emit n rays from the lights, chosen according to their
+        power.'''
+        return self.emit(self.rng.choice(len(self.lights), n,
+                                         p=self.light_probability))
+
+    def emit(self, choice):
+        '''Emit one ray from each light index in choice.'''
+        rng = self.rng
+        n = len(choice)
+        ox, oy, angle, color = (np.zeros(n), np.zeros(n), np.zeros(n),
+                                np.zeros((n, 3)))
+
+        for i, light in enumerate(self.lights):
+            rays = np.flatnonzero(choice == i)
+            k = len(rays)
+            polar_angle = np.radians(sample(light[3], k, rng))
+            polar_distance = sample(light[4], k, rng)
+            ox[rays] = (sample(light[1], k, rng)
+                        + np.cos(polar_angle) * polar_distance)
+            oy[rays] = (sample(light[2], k, rng)
+                        + np.sin(polar_angle) * polar_distance)
+            angle[rays] = np.radians(sample(light[5], k, rng))
+
+            # Resample invisible wavelengths, as hqz does
+            todo = rays
+            for tries in range(1000):
+                color[todo] = wavelength_to_rgb(
+                    sample(light[6], len(todo), rng))
+                todo = todo[~color[todo].any(axis=1)]
+                if not len(todo):
+                    break
+
+        visible = color.any(axis=1)
+        return (ox[visible], oy[visible], np.cos(angle[visible]),
+                np.sin(angle[visible]), color[visible])
+
+    def choose_outcomes(self, obj):
+        '''Choose a random material outcome for rays hitting segments,
+        according to the outcome weights.'''
+        material = self.material[obj]
+        r = self.rng.uniform(size=len(obj))
+        choice = (r[:, None] > self.outcome_weight[material]).sum(axis=1)
+        choice = np.minimum(choice, self.outcome_type.shape[1] - 1)
+        outcome = self.outcome_type[material, choice]
+        absorbed = r > self.outcome_weight[material, -1]
+        outcome[absorbed] = ABSORB
+        return outcome
+
+    def scatter(self, obj, u, dx, dy, outcome):
+        '''Change the direction of rays in place, after they hit
+        segments at position u with the outcome in argument.'''
+        diffuse = outcome == DIFFUSE
+        angle = self.rng.uniform(0.0, 2.0 * np.pi, diffuse.sum())
+        dx[diffuse] = np.cos(angle)
+        dy[diffuse] = np.sin(angle)
+
+        reflect = outcome == REFLECT
+        nx, ny = self.normals(obj[reflect], u[reflect])
+        dot = 2.0 * (nx * dx[reflect] + ny * dy[reflect]) / (
+            nx * nx + ny * ny)
+        dx[reflect] -= dot * nx
+        dy[reflect] -= dot * ny
+
+    def normals(self, obj, u):
+        '''Get the (unnormalized) normals of segments at position u.'''
+        tree = self.tree
+        nx = -tree.dy[obj]
+        ny = tree.dx[obj].copy()
+        interpolated = self.interpolated[obj]
+        angle = np.radians(self.angle[obj] + u * self.angle_delta[obj])
+        nx[interpolated] = np.cos(angle[interpolated])
+        ny[interpolated] = np.sin(angle[interpolated])
+        return nx, ny
+
+
+class Preview(Tracer):
+    '''Trace a hqz scene into a linear histogram image.'''
+
+    def __init__(self, scene, scale=1.0, seed=None):
+        super().__init__(scene, seed)
+        width, height = scene['resolution']
+        self.width = max(int(width * scale), 1)
+        self.height = max(int(height * scale), 1)
+        self.histogram = np.zeros((3, self.height, self.width))
+        self.rays = 0
+
+    def trace(self, n):
+        '''Trace n more rays into the histogram.'''
+        ox, oy, dx, dy, color = self.init_rays(n)
+        last = np.full(len(ox), -1, dtype=np.int64)
+        self.rays += n
+
+        vx, vy, vw, vh = self.viewport
+        viewport = np.array([[vx, vy, vx + vw, vy + vh]])
+
+        for bounce in range(MAX_BOUNCES):
+            if not len(ox):
+                break
+
+            t, obj, u = self.tree.intersect(ox, oy, dx, dy, last)
+            hit = obj >= 0
+
+            # Rays which hit nothing end at the viewport's far edge
+            enter, leave = box_intersection(ox, oy, dx, dy, viewport)
+            leave = np.where(leave >= np.maximum(enter, 0.0), leave, 0.0)
+            t = np.where(hit, t, leave)
+
+            px = ox + t * dx
+            py = oy + t * dy
+            self.draw_lines(ox, oy, px, py, color)
+
+            # Choose material outcomes for rays which hit something
+            ox, oy, dx, dy, color, obj, u, px, py = (
+                a[hit] for a in (ox, oy, dx, dy, color, obj, u, px, py))
+            outcome = self.choose_outcomes(obj)
+            self.scatter(obj, u, dx, dy, outcome)
+
+            alive = outcome != ABSORB
+            ox, oy, dx, dy, color, last = (
+                a[alive] for a in (px, py, dx, dy, color, obj))
+
+    def draw_lines(self, x0, y0, x1, y1, color):
+        '''Draw antialiased lines into the histogram.
+
+        Like hqz, the brightness of a line is proportional to its length.'''
+        vx, vy, vw, vh = self.viewport
+        sx = self.width / vw
+        sy = self.height / vh
+        x0, x1 = (x0 - vx) * sx, (x1 - vx) * sx
+        y0, y1 = (y0 - vy) * sy, (y1 - vy) * sy
+
+        x0, y0, x1, y1, inside = clip_lines(
+            x0, y0, x1, y1, self.width - 1.0, self.height - 1.0)
+        x0, y0, x1, y1, color = (a[inside] for a in (x0, y0, x1, y1, color))
+
+        # One sample per pixel along the major axis of each line
+        length = np.hypot(x1 - x0, y1 - y0)
+        major = np.maximum(np.abs(x1 - x0), np.abs(y1 - y0))
+        steps = np.maximum(np.ceil(major), 1).astype(np.int64)
+        steep = np.abs(y1 - y0) > np.abs(x1 - x0)
+
+        for line, x, y in sample_lines(x0, y0, x1, y1, steps):
+            weight = (128.0 * length / steps)[line]
+            self.splat(x, y, steep[line], weight, color[line])
+
+    def splat(self, x, y, steep, weight, color):
+        '''Add weighted colors to the histogram, Wu style: each sample
+        is split between the two nearest pixels across the line.'''
+        major = np.where(steep, y, x)
+        minor = np.where(steep, x, y)
+        m = np.floor(major + 0.5).astype(np.int64)
+        n = np.floor(minor).astype(np.int64)
+        frac = minor - n
+
+        size = self.width * self.height
+        limit = np.where(steep, self.width, self.height)
+        index = np.concatenate((
+            np.where(steep, m * self.width + n, n * self.width + m),
+            np.where(steep, m * self.width + n + 1, (n + 1) * self.width + m)))
+        valid = np.concatenate((np.ones(len(n), bool), n + 1 < limit))
+        index = index[valid]
+        weight = np.concatenate((weight * (1 - frac), weight * frac))[valid]
+        color = np.concatenate((color, color))[valid]
+
+        for c in range(3):
+            self.histogram[c] += np.bincount(
+                index, weight * color[:, c], minlength=size).reshape(
+                    self.height, self.width)
+
+    def display(self):
+        '''Tone map the histogram to display values from 0 to 1, as an
+        array of shape (height, width, 3) with rows from the top.
+
+        The exposure calculation matches hqz.'''
+        gamma = self.scene.get('gamma', 0) or 1.0
+        exposure = self.scene['exposure']
+        area_scale = np.sqrt(self.width * self.height / (1024.0 * 576.0))
+        intensity_scale = self.light_power / (255.0 * 8192.0)
+        scale = (np.exp(1.0 + 10.0 * exposure) * area_scale
+                 * intensity_scale / max(self.rays, 1))
+        linear = np.maximum(self.histogram.transpose(1, 2, 0) * scale,
+                            0.0)
+        return np.minimum(linear ** (1.0 / gamma), 1.0)
+
+    def image(self):
+        '''Tone map the histogram to 8-bit RGB pixels, rows from the
+        top.'''
+        return (255.0 * self.display()).astype(np.uint8)
+
+
+def clip_lines(x0, y0, x1, y1, right, bottom):
+    '''Clip lines to the rectangle from (0, 0) to (right, bottom).
+
+    Uses the Liang-Barsky algorithm. Returns the clipped lines, and
+    which lines are at least partly inside.'''
+    dx = x1 - x0
+    dy = y1 - y0
+    t0 = np.zeros(len(x0))
+    t1 = np.ones(len(x0))
+    inside = np.isfinite(dx) & np.isfinite(dy)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for p, q in ((-dx, x0), (dx, right - x0), (-dy, y0), (dy, bottom - y0)):
+            r = q / p
+            parallel = p == 0
+            inside &= ~(parallel & (q < 0))
+            t0 = np.where(~parallel & (p < 0), np.maximum(t0, r), t0)
+            t1 = np.where(~parallel & (p > 0), np.minimum(t1, r), t1)
+    inside &= t0 <= t1
+    return (x0 + t0 * dx, y0 + t0 * dy, x0 + t1 * dx, y0 + t1 * dy, inside)
+
+
+def sample_lines(x0, y0, x1, y1, steps, centered=True):
+    '''Sample points evenly along lines, steps[i] of them on line i.
+
+    Yields chunks of at most DRAW_CHUNK samples, as the index of the
+    line of each sample and its coordinates. Centered samples are in
+    the middle of equal parts of each line, others include its ends.'''
+    ends = np.cumsum(steps)
+    start = 0
+    while start < len(steps):
+        offset = ends[start] - steps[start]
+        stop = max(np.searchsorted(ends, offset + DRAW_CHUNK, 'right'),
+                   start + 1)
+        count = steps[start:stop]
+        line = start + np.repeat(np.arange(stop - start), count)
+        k = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count,
+                                                count)
+        if centered:
+            f = (k + 0.5) / steps[line]
+        else:
+            f = k / np.maximum(steps - 1, 1)[line]
+        yield (line, x0[line] + f * (x1[line] - x0[line]),
+               y0[line] + f * (y1[line] - y0[line]))
+        start = stop
+
+
+def render(scene, rays=None, scale=1.0, batch=10000, warnings=None):
+    '''Render a preview of a scene, returning 8-bit RGB pixels as an
+    array of shape (height, width, 3).
+
+    The resolution is multiplied by scale. Exposure is compensated, so
+    the brightness is the same at any scale. Warnings about skipped
+    lights, materials and segments are appended to warnings, if given.'''
+    preview = Preview(scene, scale)
+    if warnings is not None:
+        warnings.extend(preview.warnings)
+    rays = rays or scene.get('rays') or batch
+    # Without lights, the image stays black
+    while preview.lights and preview.rays < rays:
+        preview.trace(min(batch, rays - preview.rays))
+    return preview.image()
+
+
+def write_png(path, pixels):
+    '''Write 8-bit RGB pixels to a PNG file.'''
+    height, width = pixels.shape[:2]
+    raw = b''.join(b'\x00' + row.tobytes() for row in pixels)
+
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data
+                + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n'
+                + chunk(b'IHDR', struct.pack('>IIBBBBB',
+                                             width, height, 8, 2, 0, 0, 0))
+                + chunk(b'IDAT', zlib.compress(raw))
+                + chunk(b'IEND', b''))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (3, 4, 5):
+        sys.stderr.write(
+            'usage: preview.py scene.json preview.png [rays [scale]]\n')
+        sys.exit(1)
+    scene = json.load(open(sys.argv[1]))
+    rays = int(sys.argv[3]) if len(sys.argv) > 3 else 20000
+    scale = float(sys.argv[4]) if len(sys.argv) > 4 else 0.5
+    warnings = []
+    write_png(sys.argv[2], render(scene, rays, scale, warnings=warnings))
+    for warning in warnings:
+        sys.stderr.write(warning + '\n')
@@ -0,0 +1,187 @@
+#
+#   Python binding for in-process rendering with hqz.
+#
+#   Build the shared library first with `make lib`. This module looks
+#   for libhqz.so next to itself, or at the path in the HQZ_LIBRARY
+#   environment variable.
+#
+#   Scenes are rendered without writing them to disk or spawning an
+#   hqz process. The GIL is released while rays are traced, so several
+#   scenes can render concurrently from a thread pool:
+#
+#      from concurrent.futures import ThreadPoolExecutor
+#      with ThreadPoolExecutor(8) as pool:
+#          images = list(pool.map(hqzlib.render, scenes))
+#
+#   Scenes are dicts in the hqz JSON format. The "objects" member may
+#   also be a NumPy array with one row per object, which is passed to
+#   the renderer as an array of doubles instead of JSON text. Pixels are
+#   tone mapped directly into the returned buffer.
+#
+######################################################################
+#
+#   This file is part of HQZ, the batch renderer for Zen Photon Garden.
+#
+
+import array
+import ctypes
+import json
+import os
+
+
+_lib = None
+
+
+def _load_library():
+    global _lib
+    if _lib is not None:
+        return _lib
+
+    path = os.environ.get('HQZ_LIBRARY', os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'libhqz.so'))
+    lib = ctypes.CDLL(path)
+
+    lib.hqz_scene_new.argtypes = [ctypes.c_char_p]
+    lib.hqz_scene_new.restype = ctypes.c_void_p
+    lib.hqz_scene_new_objects.argtypes = [
+        ctypes.c_char_p, ctypes.POINTER(ctypes.c_double),
+        ctypes.c_uint, ctypes.c_uint]
+    lib.hqz_scene_new_objects.restype = ctypes.c_void_p
+    lib.hqz_scene_free.argtypes = [ctypes.c_void_p]
+    lib.hqz_scene_free.restype = None
+    lib.hqz_scene_error.argtypes = [ctypes.c_void_p]
+    lib.hqz_scene_error.restype = ctypes.c_char_p
+    lib.hqz_scene_width.argtypes = [ctypes.c_void_p]
+    lib.hqz_scene_width.restype = ctypes.c_uint
+    lib.hqz_scene_height.argtypes = [ctypes.c_void_p]
+    lib.hqz_scene_height.restype = ctypes.c_uint
+    lib.hqz_render.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+    lib.hqz_render.restype = ctypes.c_int
+    lib.hqz_render_histogram.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+    lib.hqz_render_histogram.restype = ctypes.c_uint64
+    lib.hqz_interrupt.argtypes = [ctypes.c_void_p]
+    lib.hqz_interrupt.restype = None
+
+    _lib = lib
+    return lib
+
+
+class SceneError(Exception):
+    '''Raised when a scene can't be parsed or rendered.'''
+
+
+def _encode_default(value):
+    # NumPy scalars
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+
+def encode_scene(scene):
+    '''Encode a scene for the renderer.
+
+    Returns the JSON bytes of the scene, and its objects as a contiguous
+    2D array of doubles if they are a NumPy array, or None.'''
+    if isinstance(scene, bytes):
+        return scene, None
+    if isinstance(scene, str):
+        return scene.encode('utf-8'), None
+
+    objects = scene.get('objects')
+    if hasattr(objects, 'tolist'):
+        # Only scenes with array objects need NumPy
+        import numpy as np
+        objects = np.ascontiguousarray(objects, dtype=np.float64)
+        if objects.ndim != 2:
+            raise SceneError('Objects must be an array with one row per '
+                             'object, not %d dimensions' % objects.ndim)
+        scene = dict(scene)
+        del scene['objects']
+    else:
+        objects = None
+
+    return json.dumps(scene, default=_encode_default).encode('utf-8'), objects
+
+
+class Scene:
+    '''A scene loaded in the renderer.
+
+    Each Scene may be rendered once, rendering it again raises
+    SceneError. Different scenes may be rendered concurrently from
+    different threads.'''
+
+    def __init__(self, scene):
+        self._lib = _load_library()
+        json_bytes, objects = encode_scene(scene)
+        if objects is None:
+            self._handle = self._lib.hqz_scene_new(json_bytes)
+        else:
+            # Copied into the scene, the array may be freed afterwards
+            self._handle = self._lib.hqz_scene_new_objects(
+                json_bytes, objects.ctypes.data_as(
+                    ctypes.POINTER(ctypes.c_double)),
+                objects.shape[0], objects.shape[1])
+        self._check()
+        self.width = self._lib.hqz_scene_width(self._handle)
+        self.height = self._lib.hqz_scene_height(self._handle)
+
+    def __del__(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if getattr(self, '_handle', None):
+            self._lib.hqz_scene_free(self._handle)
+            self._handle = None
+
+    def _check(self):
+        error = self._lib.hqz_scene_error(self._handle)
+        if error:
+            raise SceneError(error.decode('utf-8', 'replace'))
+
+    def render(self):
+        '''Render the scene, returning 8-bit RGB pixels as a bytearray
+        of height * width * 3 bytes, like hqz's PNG output. The renderer
+        writes them in place, and NumPy can wrap them without a copy,
+        with numpy.frombuffer.'''
+        pixels = bytearray(self.width * self.height * 3)
+        buf = (ctypes.c_ubyte * len(pixels)).from_buffer(pixels)
+        if self._lib.hqz_render(self._handle, buf):
+            self._check()
+        return pixels
+
+    def render_histogram(self):
+        '''Render the scene, returning the raw linear histogram and the
+        number of rays traced.
+
+        The histogram is an array of height * width * 3 64-bit counts,
+        before exposure and gamma are applied.'''
+        counts = array.array('q', bytes(8 * self.width * self.height * 3))
+        address, length = counts.buffer_info()
+        rays = self._lib.hqz_render_histogram(self._handle, address)
+        if not rays:
+            self._check()
+        return counts, rays
+
+    def interrupt(self):
+        '''Stop a render in progress from another thread. The render
+        returns after the current batch of rays.'''
+        self._lib.hqz_interrupt(self._handle)
+
+
+def render(scene):
+    '''Render a scene, returning its (width, height, pixels).'''
+    with Scene(scene) as s:
+        return s.width, s.height, s.render()
+
+
+def render_histogram(scene):
+    '''Render a scene, returning its (width, height, counts, rays).'''
+    with Scene(scene) as s:
+        counts, rays = s.render_histogram()
+        return s.width, s.height, counts, rays
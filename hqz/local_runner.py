@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+#
+#   Local runner: Render exported frames on this computer, using
+#   several hqz processes at once.
+#
+#   This reads the render.json manifest written next to the render
+#   script by the Blender exporter. The manifest lists each frame's
+#   scene and image paths, with a relative cost estimated from its
+#   segments, lights, materials and number of rays.
+#
+#   Frames are dispatched longest first. With frames of very different
+#   render times, this keeps the slowest frames from running alone at
+#   the end of the job while other cores are idle.
+#
+#   Frames split into sub-jobs render raw histograms, which are merged
+#   with merge.py as soon as all sub-jobs of a frame are done.
+#
+#   usage: local_runner.py [-j WORKERS] render.json
+#
+######################################################################
+#
+#   This file is part of HQZ, the batch renderer for Zen Photon Garden.
+#
+
+import argparse
+import collections
+import heapq
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+# Modules of the Blender exporter which don't depend on bpy
+EXPORTER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'export', 'io_export_hqz')
+
+
+def load_manifest(path):
+    '''Read a render manifest written by the exporter.'''
+    with open(path) as f:
+        return json.load(f)
+
+
+def schedule(frames):
+    '''Sort frames longest first.'''
+    return sorted(frames, key=lambda frame: frame['cost'], reverse=True)
+
+
+def predict_makespan(frames, workers):
+    '''Predict the total cost of the longest worker, when frames are
+    dispatched in order to the first idle worker.'''
+    loads = [0.0] * workers
+    for frame in frames:
+        heapq.heapreplace(loads, loads[0] + frame['cost'])
+    return max(loads)
+
+
+def render_frame(hqz, frame, ignore=False):
+    '''Render a single frame or sub-job, returning hqz's exit code.'''
+    if ignore and os.path.exists(frame.get('merge', frame['image'])):
+        return 0
+    if 'merge' in frame:
+        return subprocess.call([hqz, '--histogram',
+                                frame['scene'], frame['image']])
+    return subprocess.call([hqz, frame['scene'], frame['image']])
+
+
+def merge_frame(image, parts):
+    '''Merge the histograms of a split frame's sub-jobs into its image.
+    Returns 0 on success.'''
+    # Only split frames need NumPy
+    import merge
+
+    try:
+        merge.merge_files(parts[0]['scene'], image,
+                          [part['image'] for part in parts])
+    except (OSError, ValueError) as e:
+        sys.stderr.write('Error merging %s: %s\n' % (image, e))
+        return 1
+    return 0
+
+
+def run(manifest, workers, on_frame=None, window=None):
+    '''Render all frames of the manifest, longest first.
+
+    on_frame is called from the main thread with each frame and its exit
+    code, as soon as it is rendered. For split frames, it is called with
+    each sub-job, then with the merged frame. Returns the number of
+    failed frames.
+
+    If window is set, frames are dispatched in manifest order instead,
+    and only once the frame window places before them is done. This
+    bounds the number of frames done out of order, for streaming them
+    in order.'''
+    if window:
+        frames = list(manifest['frames'])
+    else:
+        frames = schedule(manifest['frames'])
+    ignore = manifest.get('ignore', False)
+    failures = 0
+
+    # Sub-jobs of each split frame, and how many are left to render
+    parts = collections.defaultdict(list)
+    for frame in frames:
+        if 'merge' in frame:
+            parts[frame['merge']].append(frame)
+    remaining = {image: len(jobs) for image, jobs in parts.items()}
+    failed = set()
+
+    def frame_done(frame, returncode):
+        nonlocal failures
+        if returncode:
+            failures += 1
+        if on_frame is not None:
+            on_frame(frame, returncode)
+
+        image = frame.get('merge')
+        if image is None:
+            return
+        if returncode:
+            failed.add(image)
+        remaining[image] -= 1
+        if remaining[image]:
+            return
+
+        jobs = sorted(parts[image], key=lambda part: part['scene'])
+        merged = {'scene': jobs[0]['scene'], 'image': image,
+                  'cost': sum(job['cost'] for job in jobs)}
+        if image in failed:
+            # Failed sub-jobs were already counted
+            if on_frame is not None:
+                on_frame(merged, 1)
+            return
+        if ignore and os.path.exists(image):
+            returncode = 0
+        else:
+            returncode = merge_frame(image, jobs)
+        if returncode:
+            failures += 1
+        if on_frame is not None:
+            on_frame(merged, returncode)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        finished = [False] * len(frames)
+        first = 0
+        submitted = 0
+        while True:
+            limit = len(frames)
+            if window:
+                limit = min(limit, first + window)
+            while submitted < limit:
+                future = executor.submit(render_frame, manifest['hqz'],
+                                         frames[submitted], ignore)
+                futures[future] = submitted
+                submitted += 1
+            if not futures:
+                break
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = futures.pop(future)
+                finished[index] = True
+                frame_done(frames[index], future.result())
+            while first < len(frames) and finished[first]:
+                first += 1
+
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Render exported frames locally, longest first.')
+    parser.add_argument('manifest', help='render.json written by the exporter')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(),
+                        help='number of hqz processes to run at once')
+    args = parser.parse_args()
+
+    manifest = load_manifest(args.manifest)
+    frames = manifest['frames']
+    if not frames:
+        return 0
+
+    total = sum(frame['cost'] for frame in frames)
+    makespan = predict_makespan(schedule(frames), args.workers)
+    if makespan:
+        print('Rendering %d jobs on %d workers, %.0f%% predicted utilization'
+              % (len(frames), args.workers,
+                 100.0 * total / (makespan * args.workers)))
+
+    rays = sum(frame.get('rays', 0) for frame in frames)
+    if rays:
+        print('Total %d rays' % rays)
+    if 'seconds_per_cost' in manifest:
+        # Measured by the exporter on its own computer, and formatted
+        # like its prediction
+        sys.path.append(EXPORTER_DIR)
+        from adaptive import format_duration
+        print('Predicted render time %s'
+              % format_duration(makespan * manifest['seconds_per_cost']))
+
+    # Split frames are also counted once merged
+    steps = len(frames) + len(set(frame['merge'] for frame in frames
+                                  if 'merge' in frame))
+    done = [0]
+    start = time.time()
+
+    def on_frame(frame, returncode):
+        done[0] += 1
+        status = 'failed (%d)' % returncode if returncode else 'done'
+        print('[%d/%d] %s %s' % (done[0], steps, frame['image'], status))
+
+    failures = run(manifest, args.workers, on_frame)
+    print('Rendered %d jobs in %.1fs, %d failed'
+          % (steps, time.time() - start, failures))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+#
+#   Merge: Combine renders of one frame split across several hqz
+#   processes or computers.
+#
+#   A frame of N rays can be split into sub-jobs of N/k rays each, with
+#   seeds k apart, as the Blender exporter does. Each sub-job is
+#   rendered with "hqz --histogram", writing its raw linear histogram
+#   instead of a PNG. This tool adds up the histograms and tone maps
+#   the sum with the scene's exposure and gamma, exactly as hqz would
+#   have done for a single render of all the rays.
+#
+#   Requires NumPy.
+#
+#   usage: merge.py scene.json output.png part.hist [part.hist ...]
+#
+######################################################################
+#
+#   This file is part of HQZ, the batch renderer for Zen Photon Garden.
+#
+
+import argparse
+import functools
+import json
+import math
+import os
+import struct
+import sys
+
+import numpy as np
+
+# Modules of the Blender exporter which don't depend on bpy
+EXPORTER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'export', 'io_export_hqz')
+sys.path.append(EXPORTER_DIR)
+from preview import write_png
+
+
+HEADER = struct.Struct('<4sIIIQ')
+
+
+def read_histogram(path):
+    '''Read a histogram written by hqz --histogram.
+
+    Returns its counts, as an array of shape (height, width, channels),
+    and the number of rays traced.'''
+    with open(path, 'rb') as f:
+        magic, width, height, channels, rays = HEADER.unpack(
+            f.read(HEADER.size))
+        if magic != b'HQZH':
+            raise ValueError('%s is not an hqz histogram' % path)
+        counts = np.fromfile(f, dtype='<i8', count=width * height * channels)
+    if len(counts) != width * height * channels:
+        raise ValueError('%s is truncated' % path)
+    return counts.reshape(height, width, channels), rays
+
+
+@functools.lru_cache(maxsize=4)
+def dither(size):
+    '''Get the dither hqz adds to each of size channel values, in
+    [0, 1).
+
+    This is the sequence of hqz's PRNG (Bob Jenkins' small PRNG) seeded
+    with 0. It can't be vectorized, so it is cached for each image size,
+    as frames of an animation usually share theirs.'''
+    mask = 0xffffffff
+    a, b, c, d = 0xf1ea5eed, 0, 0, 0
+    # Seeding runs 20 rounds
+    values = [0] * (size + 20)
+    for i in range(size + 20):
+        e = (a - ((b << 27 | b >> 5) & mask)) & mask
+        a = b ^ ((c << 17 | c >> 15) & mask)
+        b = (c + d) & mask
+        c = (d + e) & mask
+        d = values[i] = (e + a) & mask
+    return np.array(values[20:], dtype=np.float64) * 2.3283064365386963e-10
+
+
+def tone_map(scene, counts, rays):
+    '''Convert linear counts to 8-bit pixels, with the scene's exposure
+    and gamma. The calculation and dither match hqz, so the pixels are
+    the same.'''
+    height, width = counts.shape[:2]
+    gamma = scene.get('gamma') or 1.0
+    if gamma <= 0.0:
+        gamma = 1.0
+    light_power = sum(light[0] for light in scene['lights'])
+
+    area_scale = math.sqrt(width * height / (1024.0 * 576.0))
+    intensity_scale = light_power / (255.0 * 8192.0)
+    scale = (math.exp(1.0 + 10.0 * scene['exposure']) * area_scale
+             * intensity_scale / rays)
+
+    linear = np.maximum(counts * scale, 0.0)
+    # np.power, as ** may use sqrt, which can round differently than pow
+    value = (255.0 * np.power(linear, 1.0 / gamma)
+             + dither(counts.size).reshape(counts.shape))
+    return np.clip(value, 0.0, 255.9).astype(np.uint8)
+
+
+def merge(scene, paths):
+    '''Add up histograms of the same scene, returning 8-bit pixels and
+    the total number of rays.'''
+    total, rays = read_histogram(paths[0])
+    for path in paths[1:]:
+        counts, part_rays = read_histogram(path)
+        if counts.shape != total.shape:
+            raise ValueError('%s is %dx%d, expected %dx%d' % (
+                path, counts.shape[1], counts.shape[0],
+                total.shape[1], total.shape[0]))
+        total += counts
+        rays += part_rays
+    if not rays:
+        raise ValueError('No rays were traced')
+    return tone_map(scene, total, rays), rays
+
+
+def merge_files(scene_path, output_path, paths):
+    '''Merge histogram files into a PNG, using the exposure and gamma of
+    the scene file. Returns the total number of rays.'''
+    with open(scene_path) as f:
+        scene = json.load(f)
+    pixels, rays = merge(scene, paths)
+    write_png(output_path, pixels)
+    return rays
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Merge hqz histograms of one frame into a PNG.')
+    parser.add_argument('scene', help='scene file, for exposure and gamma')
+    parser.add_argument('output', help='PNG file to write')
+    parser.add_argument('parts', nargs='+',
+                        help='histograms written by hqz --histogram')
+    args = parser.parse_args()
+
+    try:
+        rays = merge_files(args.scene, args.output, args.parts)
+    except (OSError, ValueError) as e:
+        sys.stderr.write('merge.py: %s\n' % e)
+        return 1
+
+    print('Merged %d histograms, %d rays, into %s'
+          % (len(args.parts), rays, args.output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -45,14 +45,21 @@ void HistogramImage::clear()
 
 void HistogramImage::render(std::vector<unsigned char> &rgb, double scale, double exponent)
 {
-    // Tone mapping from 64-bit-per-channel to 8-bit-per-channel, with dithering.
+    rgb.resize(mWidth * mHeight * kChannels);
+    if (!rgb.empty())
+        render(&rgb[0], scale, exponent);
+}
+
+void HistogramImage::render(unsigned char *rgb, double scale, double exponent)
+{
+    // Tone mapping from 64-bit-per-channel to 8-bit-per-channel, with dithering,
+    // into a buffer of width * height * kChannels bytes.
 
     PRNG rng;
     rng.seed(0);
 
     unsigned i = 0;
     unsigned e = mWidth * mHeight * kChannels; 
-    rgb.resize(e);
 
     for (; i != e; ++i) {
         double u = std::max(0.0, mCounts[i] * scale);
@@ -39,13 +39,16 @@ public:
     void resize(unsigned w, unsigned h);
     void clear();
     void render(std::vector<unsigned char> &rgb, double scale, double exponent);
+    void render(unsigned char *rgb, double scale, double exponent);
     void line(Color color, double x0, double y0, double x1, double y1);
 
     unsigned width() const { return mWidth; }
     unsigned height() const { return mHeight; }
 
-private:
     static const unsigned kChannels = 3;
+    const int64_t *counts() const { return &mCounts[0]; }
+
+private:
     uint32_t mWidth, mHeight;
     std::vector<int64_t> mCounts;
 };
@@ -0,0 +1,220 @@
+/*
+ * This file is part of HQZ, the batch renderer for Zen Photon Garden.
+ *
+ * Permission is hereby granted, free of charge, to any person
+ * obtaining a copy of this software and associated documentation
+ * files (the "Software"), to deal in the Software without
+ * restriction, including without limitation the rights to use,
+ * copy, modify, merge, publish, distribute, sublicense, and/or sell
+ * copies of the Software, and to permit persons to whom the
+ * Software is furnished to do so, subject to the following
+ * conditions:
+ *
+ * The above copyright notice and this permission notice shall be
+ * included in all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+ * EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+ * OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+ * NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+ * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+ * WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ * FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ * OTHER DEALINGS IN THE SOFTWARE.
+ */
+
+/*
+ * C interface to the renderer, for use from other languages without
+ * spawning an hqz process. See hqzlib.py for the Python binding.
+ *
+ * Each handle owns its scene and renderer, so several scenes may be
+ * rendered concurrently from different threads. A scene is rendered
+ * once: the histogram isn't cleared between renders.
+ *
+ * Objects may be passed as an array of doubles, one row per object,
+ * instead of in the JSON text, to skip formatting and parsing them.
+ */
+
+#include "rapidjson/document.h"
+#include "zrender.h"
+#include <string.h>
+#include <string>
+#include <vector>
+
+
+struct HQZScene {
+    rapidjson::Document document;
+    std::vector<char> json;
+    ZRender *renderer;
+    std::string error;
+    bool rendered;
+};
+
+
+static bool setObjects(HQZScene *scene, const double *objects,
+    unsigned rows, unsigned columns)
+{
+    /*
+     * Replace the scene's objects with rows of an array of doubles.
+     * Material IDs in the first column are stored as integers, unless
+     * they aren't, for the renderer to report them.
+     */
+
+    rapidjson::Document &document = scene->document;
+    if (!document.IsObject()) {
+        scene->error = "Scene is not an object\n";
+        return false;
+    }
+
+    rapidjson::Document::AllocatorType &allocator = document.GetAllocator();
+    rapidjson::Value array(rapidjson::kArrayType);
+    array.Reserve(rows, allocator);
+
+    for (unsigned i = 0; i < rows; ++i) {
+        const double *row = objects + (size_t)i * columns;
+        rapidjson::Value object(rapidjson::kArrayType);
+        object.Reserve(columns, allocator);
+
+        for (unsigned j = 0; j < columns; ++j) {
+            if (j == 0 && row[j] >= 0 && row[j] < 4294967296.0
+                && row[j] == (unsigned)row[j])
+                object.PushBack((unsigned)row[j], allocator);
+            else
+                object.PushBack(row[j], allocator);
+        }
+        array.PushBack(object, allocator);
+    }
+
+    document.RemoveMember("objects");
+    document.AddMember("objects", array, allocator);
+    return true;
+}
+
+
+extern "C" {
+
+HQZScene *hqz_scene_new_objects(const char *json, const double *objects,
+    unsigned rows, unsigned columns)
+{
+    /*
+     * Parse a JSON scene and create its renderer. If objects isn't
+     * null, it holds rows * columns doubles which replace the scene's
+     * objects. Always returns a handle, check hqz_scene_error() for
+     * parse or scene errors.
+     */
+
+    HQZScene *scene = new HQZScene;
+    scene->renderer = 0;
+    scene->rendered = false;
+
+    // Parse in place, from a private copy of the string
+    scene->json.assign(json, json + strlen(json) + 1);
+    scene->document.ParseInsitu<0>(&scene->json[0]);
+
+    if (scene->document.HasParseError()) {
+        scene->error = "Parse error: ";
+        scene->error += scene->document.GetParseError();
+        scene->error += "\n";
+        return scene;
+    }
+
+    if (objects && !setObjects(scene, objects, rows, columns))
+        return scene;
+
+    scene->renderer = new ZRender(scene->document);
+    if (scene->renderer->hasError())
+        scene->error = scene->renderer->errorText();
+
+    return scene;
+}
+
+HQZScene *hqz_scene_new(const char *json)
+{
+    return hqz_scene_new_objects(json, 0, 0, 0);
+}
+
+static bool startRender(HQZScene *scene)
+{
+    // Renders would add up in the same histogram
+    if (scene->error.empty() && scene->rendered)
+        scene->error = "Scene was already rendered\n";
+    scene->rendered = true;
+    return scene->error.empty();
+}
+
+void hqz_scene_free(HQZScene *scene)
+{
+    delete scene->renderer;
+    delete scene;
+}
+
+const char *hqz_scene_error(HQZScene *scene)
+{
+    return scene->error.empty() ? 0 : scene->error.c_str();
+}
+
+unsigned hqz_scene_width(HQZScene *scene)
+{
+    return scene->renderer ? scene->renderer->width() : 0;
+}
+
+unsigned hqz_scene_height(HQZScene *scene)
+{
+    return scene->renderer ? scene->renderer->height() : 0;
+}
+
+int hqz_render(HQZScene *scene, unsigned char *pixels)
+{
+    /*
+     * Render to a caller-allocated buffer of width * height * 3 bytes.
+     * Returns nonzero on error.
+     */
+
+    if (!startRender(scene))
+        return 1;
+
+    uint64_t numRays = scene->renderer->renderHistogram();
+    if (scene->renderer->hasError()) {
+        scene->error = scene->renderer->errorText();
+        return 1;
+    }
+
+    // Tone mapped in place, without an intermediate copy
+    scene->renderer->toneMap(pixels, numRays);
+    if (scene->renderer->hasError()) {
+        scene->error = scene->renderer->errorText();
+        return 1;
+    }
+    return 0;
+}
+
+uint64_t hqz_render_histogram(HQZScene *scene, int64_t *counts)
+{
+    /*
+     * Render the raw linear histogram to a caller-allocated buffer of
+     * width * height * 3 counts. Returns the number of rays traced,
+     * or zero on error.
+     */
+
+    if (!startRender(scene))
+        return 0;
+
+    uint64_t numRays = scene->renderer->renderHistogram();
+    if (scene->renderer->hasError()) {
+        scene->error = scene->renderer->errorText();
+        return 0;
+    }
+
+    const HistogramImage &image = scene->renderer->image();
+    memcpy(counts, image.counts(), sizeof *counts *
+        image.width() * image.height() * HistogramImage::kChannels);
+    return numRays;
+}
+
+void hqz_interrupt(HQZScene *scene)
+{
+    if (scene->renderer)
+        scene->renderer->interrupt();
+}
+
+}  // extern "C"
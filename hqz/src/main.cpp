@@ -31,7 +31,10 @@
 #include "lodepng.h"
 #include "zrender.h"
 #include <signal.h>
+#include <stdint.h>
+#include <string.h>
 #include <unistd.h>
+#include <algorithm>
 #include <cstdio>
 #include <vector>
 
@@ -52,16 +55,71 @@ void handleSigint(int)
     }
 }
 
+static void putLittleEndian(unsigned char *bytes, uint64_t value, unsigned size)
+{
+    for (unsigned i = 0; i < size; ++i) {
+        bytes[i] = uint8_t(value >> (8 * i));
+    }
+}
+
+static bool writeHistogram(FILE *f, const HistogramImage &image, uint64_t numRays)
+{
+    /*
+     * Raw linear histogram, for merging renders of the same scene with
+     * different seeds. All values are little-endian, whatever the byte
+     * order of this machine:
+     *
+     *   "HQZH", uint32 width, uint32 height, uint32 channels,
+     *   uint64 number of rays, then int64 counts for each channel of
+     *   each pixel, row by row from the top.
+     */
+
+    unsigned char header[24] = { 'H', 'Q', 'Z', 'H' };
+    putLittleEndian(header + 4, image.width(), 4);
+    putLittleEndian(header + 8, image.height(), 4);
+    putLittleEndian(header + 12, HistogramImage::kChannels, 4);
+    putLittleEndian(header + 16, numRays, 8);
+    if (1 != fwrite(header, sizeof header, 1, f)) {
+        return false;
+    }
+
+    // Counts are converted a block at a time
+    const size_t kBlock = 4096;
+    const int64_t *counts = image.counts();
+    size_t count = size_t(image.width()) * image.height() * HistogramImage::kChannels;
+    std::vector<unsigned char> bytes(kBlock * sizeof(int64_t));
+
+    for (size_t start = 0; start < count; start += kBlock) {
+        size_t n = std::min(kBlock, count - start);
+        for (size_t i = 0; i < n; ++i) {
+            putLittleEndian(&bytes[i * sizeof(int64_t)], uint64_t(counts[start + i]), sizeof(int64_t));
+        }
+        if (n != fwrite(&bytes[0], sizeof(int64_t), n, f)) {
+            return false;
+        }
+    }
+    return true;
+}
+
 int main(int argc, char **argv)
 {
+    bool histogram = argc == 4 && !strcmp(argv[1], "--histogram");
+    if (histogram) {
+        argc--;
+        argv++;
+    }
+
     if (argc != 3) {
         fprintf(stderr,
             "\n"
             "High Quality Zen: The batch renderer for Zen photon garden\n"
             "\n"
-            "usage: hqz <scene.json> <output.png>\n"
+            "usage: hqz [--histogram] <scene.json> <output.png>\n"
             "  (Either may be \"-\" for stdin/stdout)\n"
             "\n"
+            "  --histogram   Write the raw linear histogram instead of a PNG,\n"
+            "                to merge renders with merge.py\n"
+            "\n"
             "Copyright (c) 2013 Micah Elizabeth Scott <micah@scanlime.org>\n"
             "https://github.com/scanlime/zenphoton\n"
             "\n");
@@ -92,21 +150,30 @@ int main(int argc, char **argv)
     ZRender zr(scene);
     std::vector<unsigned char> pixels;
     if (zr.hasError()) {
-        fprintf(stderr, "Scene errors:\n%s", zr.errorText());
+        fprintf(stderr, "Scene errors:\n%s", zr.errorText().c_str());
         return 5;
     }
 
     // Render, and allow Ctrl-C to interrupt at any time.
     interruptibleRenderer = &zr;
     signal(SIGINT, handleSigint);
-    zr.render(pixels);
+    uint64_t numRays = zr.renderHistogram();
     interruptibleRenderer = 0;
 
     if (zr.hasError()) {
-        fprintf(stderr, "Renderer errors:\n%s", zr.errorText());
+        fprintf(stderr, "Renderer errors:\n%s", zr.errorText().c_str());
         return 7;
     }
 
+    if (histogram) {
+        if (!writeHistogram(outputF, zr.image(), numRays)) {
+            perror("Error writing output file");
+            return 6;
+        }
+        return 0;
+    }
+
+    zr.toneMap(pixels, numRays);
     std::vector<unsigned char> png;
     lodepng::encode(png, pixels, zr.width(), zr.height(), LCT_RGB);
     if (1 != fwrite(&png[0], png.size(), 1, outputF)) {
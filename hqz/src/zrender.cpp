@@ -91,6 +91,17 @@ ZRender::ZRender(const Value &scene)
 
 void ZRender::render(std::vector<unsigned char> &pixels)
 {
+    uint64_t numRays = renderHistogram();
+    toneMap(pixels, numRays);
+}
+
+uint64_t ZRender::renderHistogram()
+{
+    /*
+     * Trace rays into the histogram image.
+     * Returns the total number of rays traced.
+     */
+
     mQuadtree.build(mObjects);
 
     /*
@@ -106,8 +117,18 @@ void ZRender::render(std::vector<unsigned char> &pixels)
      * Trace rays!
      */
 
-    uint64_t numRays = traceRays();
+    return traceRays();
+}
+
+void ZRender::toneMap(std::vector<unsigned char> &pixels, uint64_t numRays)
+{
+    pixels.resize(width() * height() * HistogramImage::kChannels);
+    if (!pixels.empty())
+        toneMap(&pixels[0], numRays);
+}
 
+void ZRender::toneMap(unsigned char *pixels, uint64_t numRays)
+{
     /*
      * Optional gamma correction. Defaults to linear, for compatibility with zenphoton.
      */
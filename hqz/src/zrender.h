@@ -45,7 +45,13 @@ public:
     void render(std::vector<unsigned char> &pixels);
     void interrupt();
 
-    const char *errorText() const { return mError.str().c_str(); }
+    // Rendering in two steps, for access to the raw histogram
+    uint64_t renderHistogram();
+    void toneMap(std::vector<unsigned char> &pixels, uint64_t numRays);
+    void toneMap(unsigned char *pixels, uint64_t numRays);
+    const HistogramImage &image() const { return mImage; }
+
+    std::string errorText() const { return mError.str(); }
     bool hasError() const { return !mError.str().empty(); }
     unsigned width() const { return mImage.width(); }
     unsigned height() const { return mImage.height(); }
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+#
+#   Thumbnails: Draw small wireframes of exported frames, to check a
+#   whole shot at a glance before rendering it.
+#
+#   Segments and lights are drawn like wireframe.html does, with random
+#   values at the middle of their range, but for every frame at once:
+#   lines are rasterized with NumPy, one sample per pixel of their major
+#   axis, and files are drawn in parallel. Thumbnails are assembled into
+#   a contact sheet, in frame order from left to right, or into a small
+#   video with ffmpeg.
+#
+#   Files may hold one scene, or one scene per line. Directories are
+#   searched for .json and .jsonl files, except the render.json
+#   manifest and all sub-jobs of split frames but the first.
+#
+#   Requires NumPy.
+#
+#   usage: thumbnails.py [-j WORKERS] [--width W] output.png|output.mp4
+#                        scene.json|directory ...
+#
+######################################################################
+#
+#   This file is part of HQZ, the batch renderer for Zen Photon Garden.
+#
+
+import argparse
+import json
+import math
+import os
+import re
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+
+# Modules of the Blender exporter which don't depend on bpy
+EXPORTER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'export', 'io_export_hqz')
+sys.path.append(EXPORTER_DIR)
+from preview import clip_lines, sample_lines, write_png
+
+
+# Colors of wireframe.html
+BACKGROUND = np.array([0x11, 0x11, 0x11])
+SEGMENT = np.array([0xff, 0xff, 0xff])
+LIGHT = np.array([0xff, 0xaa, 0xff])
+
+# Radius of the circle drawn around lights, in pixels
+LIGHT_RADIUS = 3
+
+EXTENSIONS = ('.json', '.jsonl')
+
+# Written next to the frames by the Blender exporter
+MANIFEST = 'render.json'
+PART = re.compile(r'\.part(\d+)\.json$')
+
+WHITESPACE = re.compile(r'\s*')
+
+
+def sample_center(value):
+    '''Get a typical value of a sampled value.'''
+    if isinstance(value, list):
+        if (len(value) == 2 and all(isinstance(v, (int, float))
+                                    for v in value)):
+            return (value[0] + value[1]) / 2.0
+        return 0.0
+    return value
+
+
+def segment_array(objects):
+    '''Get the ends of objects at their typical values, as an array of
+    shape (count, 4) of x0, y0, x1, y1.'''
+    try:
+        # Fast path for objects of constants only, all of the same kind
+        values = np.array(objects, dtype=float)
+        if values.ndim != 2 or values.shape[1] not in (5, 7):
+            raise ValueError
+    except (ValueError, TypeError):
+        values = np.zeros((len(objects), 5))
+        for i, obj in enumerate(objects):
+            if isinstance(obj, list) and len(obj) in (5, 7):
+                values[i, :len(obj)] = [sample_center(v) for v in obj[:5]]
+                if len(obj) == 7:
+                    values[i, 3:5] = [sample_center(v) for v in obj[4:6]]
+
+    if values.shape[1] == 7:
+        x0, y0, dx, dy = values[:, 1], values[:, 2], values[:, 4], values[:, 5]
+    else:
+        x0, y0, dx, dy = values[:, 1], values[:, 2], values[:, 3], values[:, 4]
+    return np.stack([x0, y0, x0 + dx, y0 + dy], axis=1)
+
+
+def rasterize(segments, width, height):
+    '''Count the samples of lines in each pixel, returning an array of
+    shape (height, width).'''
+    x0, y0, x1, y1, inside = clip_lines(*segments.T, right=width - 0.5,
+                                        bottom=height - 0.5)
+    x0, y0, x1, y1 = (a[inside] for a in (x0, y0, x1, y1))
+
+    # One sample per pixel along the major axis of each line
+    major = np.maximum(np.abs(x1 - x0), np.abs(y1 - y0))
+    steps = np.ceil(major).astype(np.int64) + 1
+
+    counts = np.zeros(width * height, dtype=np.int64)
+    for line, x, y in sample_lines(x0, y0, x1, y1, steps, centered=False):
+        x = np.clip(x.astype(np.int64), 0, width - 1)
+        y = np.clip(y.astype(np.int64), 0, height - 1)
+        counts += np.bincount(y * width + x, minlength=width * height)
+    return counts.reshape(height, width)
+
+
+def light_positions(lights):
+    '''Get the typical positions of lights, as arrays of x and y.'''
+    positions = np.zeros((len(lights), 2))
+    for i, light in enumerate(lights):
+        if not isinstance(light, list) or len(light) < 5:
+            continue
+        x, y, angle, distance = (sample_center(v) for v in light[1:5])
+        radians = math.radians(angle)
+        positions[i] = (x + distance * math.cos(radians),
+                        y + distance * math.sin(radians))
+    return positions.T
+
+
+def thumbnail(scene, width):
+    '''Draw the wireframe of a scene, returning 8-bit RGB pixels as an
+    array of shape (height, width, 3).'''
+    resolution = [sample_center(v) for v in scene['resolution']]
+    height = max(int(round(width * resolution[1] / resolution[0])), 1)
+    vx, vy, vw, vh = (sample_center(v) for v in scene['viewport'])
+    scale = np.array([width / vw, height / vh] * 2)
+    offset = np.array([vx, vy] * 2)
+
+    segments = (segment_array(scene['objects']).reshape(-1, 4)
+                - offset) * scale
+    # Pixels crossed by more lines are brighter
+    coverage = 1.0 - 0.5 ** rasterize(segments, width, height)
+    image = BACKGROUND + coverage[..., None] * (SEGMENT - BACKGROUND)
+
+    x, y = light_positions(scene['lights'])
+    x = (x - vx) * width / vw
+    y = (y - vy) * height / vh
+    angles = np.linspace(0, 2 * np.pi, 8 * LIGHT_RADIUS, endpoint=False)
+    for radius in (0, LIGHT_RADIUS):
+        px = np.round(x[:, None] + radius * np.cos(angles)).astype(np.int64)
+        py = np.round(y[:, None] + radius * np.sin(angles)).astype(np.int64)
+        visible = (px >= 0) & (px < width) & (py >= 0) & (py < height)
+        image[py[visible], px[visible]] = LIGHT
+
+    return image.astype(np.uint8)
+
+
+def read_scenes(path):
+    '''Read all scenes in a file, one per line or a single one.'''
+    with open(path) as f:
+        text = f.read()
+    decoder = json.JSONDecoder()
+    scenes = []
+    pos = 0
+    while True:
+        pos = WHITESPACE.match(text, pos).end()
+        if pos == len(text):
+            return scenes
+        scene, pos = decoder.raw_decode(text, pos)
+        scenes.append(scene)
+
+
+def draw_file(path, width):
+    '''Draw the thumbnails of all frames in a file. Returns the
+    thumbnails, or None and an error message.'''
+    try:
+        return [thumbnail(scene, width) for scene in read_scenes(path)], None
+    except (OSError, ValueError, KeyError, TypeError, IndexError,
+            ZeroDivisionError) as e:
+        return None, '%s: %s' % (path, e)
+
+
+def find_files(paths):
+    '''Expand directories into the scene files they contain.'''
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for directory, _, names in sorted(os.walk(path)):
+            for name in sorted(names):
+                part = PART.search(name)
+                if (name.endswith(EXTENSIONS) and name != MANIFEST
+                        and (part is None or part.group(1) == '0')):
+                    files.append(os.path.join(directory, name))
+    return files
+
+
+def fit(image, width, height):
+    '''Crop or pad an image to a size, with the background color.'''
+    cell = np.empty((height, width, 3), dtype=np.uint8)
+    cell[:] = BACKGROUND
+    h = min(height, image.shape[0])
+    w = min(width, image.shape[1])
+    cell[:h, :w] = image[:h, :w]
+    return cell
+
+
+def contact_sheet(thumbnails, columns, gap=2):
+    '''Arrange thumbnails of the same size in rows, from left to right.'''
+    height, width = thumbnails[0].shape[:2]
+    rows = -(-len(thumbnails) // columns)
+    columns = min(columns, len(thumbnails))
+    sheet = np.zeros((rows * (height + gap) - gap,
+                      columns * (width + gap) - gap, 3), dtype=np.uint8)
+    for i, image in enumerate(thumbnails):
+        row, column = divmod(i, columns)
+        top = row * (height + gap)
+        left = column * (width + gap)
+        sheet[top:top + height, left:left + width] = image
+    return sheet
+
+
+class Video:
+    '''Encode frames of the same size into a video with ffmpeg.'''
+
+    def __init__(self, output, width, height, framerate=30, ffmpeg='ffmpeg'):
+        self.error = None
+        try:
+            self.process = subprocess.Popen(
+                [ffmpeg, '-y', '-loglevel', 'error',
+                 '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+                 '-s', '%dx%d' % (width, height),
+                 '-framerate', str(framerate), '-i', '-',
+                 '-c:v', 'libx264', '-pix_fmt', 'yuv420p', output],
+                stdin=subprocess.PIPE)
+        except OSError as e:
+            self.process = None
+            self.error = "can't run %s: %s" % (ffmpeg, e)
+
+    def put(self, image):
+        '''Pipe a frame to ffmpeg, unless it failed.'''
+        if self.error is not None:
+            return
+        try:
+            self.process.stdin.write(image.tobytes())
+        except BrokenPipeError:
+            self.error = 'ffmpeg exited early'
+
+    def finish(self):
+        '''Wait for the end of the video. Returns why it failed, or
+        None.'''
+        if self.process is None:
+            return self.error
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            self.error = self.error or 'ffmpeg exited early'
+        returncode = self.process.wait()
+        if returncode:
+            return 'ffmpeg exited with code %d' % returncode
+        return self.error
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Draw wireframe thumbnails of hqz scenes into a contact '
+                    'sheet or a video.')
+    parser.add_argument('output',
+                        help='PNG contact sheet, or video file for ffmpeg')
+    parser.add_argument('paths', nargs='+',
+                        help='scene files, animations or directories')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(),
+                        help='number of files drawn at once')
+    parser.add_argument('--width', type=int, default=160,
+                        help='width of thumbnails, in pixels')
+    parser.add_argument('--columns', type=int, default=20,
+                        help='number of thumbnails in each row of the sheet')
+    parser.add_argument('--framerate', type=float, default=30)
+    parser.add_argument('--ffmpeg', default='ffmpeg',
+                        help='path to the ffmpeg executable')
+    args = parser.parse_args()
+
+    files = find_files(args.paths)
+    if not files:
+        print('No scene files found')
+        return 1
+
+    start = time.time()
+    to_video = not args.output.lower().endswith('.png')
+    thumbnails = []
+    video = None
+    size = None
+    frames = failures = 0
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        draw = partial(draw_file, width=args.width)
+        for images, error in executor.map(draw, files):
+            if error:
+                sys.stderr.write(error + '\n')
+                failures += 1
+                continue
+            for image in images:
+                if size is None:
+                    # All frames take the size of the first one, even
+                    # for yuv420p
+                    height, width = image.shape[:2]
+                    size = (width + width % 2, height + height % 2)
+                    if to_video:
+                        video = Video(args.output, size[0], size[1],
+                                      args.framerate, args.ffmpeg)
+                image = fit(image, *size)
+                if video is not None:
+                    video.put(image)
+                else:
+                    thumbnails.append(image)
+                frames += 1
+
+    if video is not None:
+        error = video.finish()
+        if error:
+            sys.stderr.write('Encoding %s failed: %s\n' % (args.output, error))
+            return 1
+    if thumbnails:
+        write_png(args.output, contact_sheet(thumbnails, args.columns))
+
+    elapsed = time.time() - start
+    print('Drew %d frames from %d files into %s in %.1f s, %.0f frames/s'
+          % (frames, len(files), args.output, elapsed,
+             frames / max(elapsed, 1e-6)))
+    if failures:
+        print('%d files failed' % failures)
+    return 1 if failures or not frames else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,545 @@
+#!/usr/bin/env python3
+#
+#   Validate: Check scene files against the hqz scene format, and print
+#   statistics for each frame.
+#
+#   Exported frames can be hundreds of megabytes, most of it objects.
+#   Instead of loading whole files, this reads them in chunks, decoding
+#   one light, object or material at a time, so that memory use doesn't
+#   depend on the size of the scene. Files may hold a single scene, or
+#   an animation with one scene per line.
+#
+#   Each frame is checked as hqz would check it: tuple lengths, material
+#   IDs within range, stopping conditions and light power. Numbers must
+#   also be finite, as NaN and infinities written by Python's json
+#   module can't be parsed by hqz. Values which hqz accepts but ignores,
+#   like unknown material outcomes, are reported as warnings.
+#
+#   Directories are searched for .json and .jsonl files, except the
+#   render.json manifest, and files are checked in parallel.
+#
+#   usage: validate.py [-j WORKERS] [-q] scene.json|directory ...
+#
+######################################################################
+#
+#   This file is part of HQZ, the batch renderer for Zen Photon Garden.
+#
+
+import argparse
+import json
+import math
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Number of characters read from a file at once
+CHUNK_SIZE = 1 << 20
+
+# Largest single value decoded at once, like one object
+MAX_VALUE = 16 << 20
+
+# Number of errors and warnings kept for each frame
+MAX_MESSAGES = 20
+
+EXTENSIONS = ('.json', '.jsonl')
+
+WHITESPACE = re.compile(r'[ \t\r\n]*')
+SEPARATOR = re.compile(r'[ \t\r\n]*([,\]])[ \t\r\n]*')
+
+# Types of plain numbers, not booleans
+CONSTANT_TYPES = {int, float}
+
+# Written next to the frames by the Blender exporter
+MANIFEST = 'render.json'
+
+
+class ParseError(ValueError):
+    '''Malformed JSON, with its character offset in the file.'''
+
+    def __init__(self, message, offset):
+        super().__init__('%s at character %d' % (message, offset))
+        self.offset = offset
+
+
+class Reader:
+    '''Read a sequence of JSON values from a text file, in chunks.
+
+    Arrays and objects can be iterated over one item at a time with
+    items() and members(). Other values are decoded whole with
+    value().'''
+
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.file = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        # Characters dropped from the start of the buffer
+        self.dropped = 0
+        self.eof = False
+
+    def tell(self):
+        '''Get the offset of the next character in the file.'''
+        return self.dropped + self.pos
+
+    def error(self, message):
+        return ParseError(message, self.tell())
+
+    def fill(self):
+        '''Read the next chunk, dropping characters already read.
+        Returns False at the end of the file.'''
+        if self.eof:
+            return False
+        chunk = self.file.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.dropped += self.pos
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        '''Skip whitespace and get the next character, or '' at the end
+        of the file.'''
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or not self.fill():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, c):
+        if self.peek() != c:
+            raise self.error("Expected '%s'" % c)
+        self.pos += 1
+
+    def value(self):
+        '''Decode the next value.'''
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as e:
+                # The value may continue in the next chunk
+                if len(self.buffer) - self.pos > MAX_VALUE:
+                    raise self.error('Value too large')
+                if self.fill():
+                    continue
+                raise ParseError(e.msg, self.dropped + e.pos)
+            # Numbers may also continue in the next chunk
+            if end < len(self.buffer) or not self.fill():
+                self.pos = end
+                return value
+
+    def items(self):
+        '''Iterate over the items of the next array.'''
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        decode = self.decoder.raw_decode
+        while True:
+            # Fast path for items followed by their separator in the
+            # buffer
+            try:
+                value, end = decode(self.buffer, self.pos)
+                match = SEPARATOR.match(self.buffer, end)
+            except json.JSONDecodeError:
+                match = None
+            if match:
+                self.pos = match.end()
+                c = match.group(1)
+            else:
+                value = self.value()
+                c = self.peek()
+                if c not in (',', ']'):
+                    raise self.error("Expected ',' or ']'")
+                self.pos += 1
+                if c == ',':
+                    self.peek()
+            yield value
+            if c == ']':
+                return
+
+    def members(self):
+        '''Iterate over the keys of the next object. The caller must
+        read each key's value before getting the next key.'''
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise self.error('Expected a string key')
+            self.expect(':')
+            yield key
+            c = self.peek()
+            self.pos += 1
+            if c == '}':
+                return
+            if c != ',':
+                self.pos -= 1
+                raise self.error("Expected ',' or '}'")
+
+
+def is_number(value):
+    # Booleans are not numbers in JSON
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def is_finite(value):
+    '''Check that all numbers in a value are finite.'''
+    if isinstance(value, float):
+        return math.isfinite(value)
+    if isinstance(value, list):
+        return all(is_finite(item) for item in value)
+    return True
+
+
+def sample_bounds(value):
+    '''Get the range of a sampled value, or None if hqz evaluates it to
+    zero.'''
+    if is_number(value):
+        return value, value
+    if (isinstance(value, list) and len(value) == 2
+            and is_number(value[0]) and is_number(value[1])):
+        return min(value), max(value)
+    return None
+
+
+def is_sampled(value):
+    '''Check that a value is one of the sampled values hqz knows.'''
+    return (sample_bounds(value) is not None
+            or (isinstance(value, list) and len(value) == 2
+                and is_number(value[0]) and value[1] == 'K'))
+
+
+class Frame:
+    '''Validation results and statistics of one scene.'''
+
+    def __init__(self, name):
+        self.name = name
+        self.segments = 0
+        self.lights = 0
+        self.materials = None
+        self.size = 0
+        self.bounds = [math.inf, math.inf, -math.inf, -math.inf]
+        self.errors = []
+        self.warnings = []
+        self.error_count = 0
+        self.warning_count = 0
+
+        self.light_power = 0.0
+        # Highest material ID used, and the first object using it
+        self.max_material = -1
+        self.max_material_object = None
+
+    def error(self, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_MESSAGES:
+            self.errors.append(message)
+
+    def warning(self, message):
+        self.warning_count += 1
+        if len(self.warnings) < MAX_MESSAGES:
+            self.warnings.append(message)
+
+    def check_finite(self, value, noun):
+        if not is_finite(value):
+            self.error('%s has a non-finite number' % noun)
+            return False
+        return True
+
+    def check_number(self, value, noun):
+        if not is_number(value):
+            self.error("'%s' expected a number value" % noun)
+            return False
+        return self.check_finite(value, noun)
+
+    def check_integer(self, value, noun):
+        if not isinstance(value, int) or isinstance(value, bool):
+            self.error("'%s' expected an integer value" % noun)
+            return False
+        return True
+
+    def check_sampled(self, value, noun):
+        if not self.check_finite(value, noun):
+            return
+        if not is_sampled(value):
+            self.warning('%s is not a known sampled value, hqz uses zero'
+                         % noun)
+
+    def check_light(self, light, index):
+        noun = 'light #%d' % index
+        if not isinstance(light, list) or len(light) < 7:
+            self.error("'%s' expected an array with at least 7 items" % noun)
+            return
+        # hqz reads the power as a plain number
+        if self.check_number(light[0], noun + ' power'):
+            self.light_power += light[0]
+        for i, value in enumerate(light[1:7], 1):
+            self.check_sampled(value, '%s [%d]' % (noun, i))
+
+    def add_bounds(self, left, top, right, bottom):
+        bounds = self.bounds
+        if left < bounds[0]:
+            bounds[0] = left
+        if top < bounds[1]:
+            bounds[1] = top
+        if right > bounds[2]:
+            bounds[2] = right
+        if bottom > bounds[3]:
+            bounds[3] = bottom
+
+    def check_object(self, obj, index):
+        # Fast path for the most common objects, constant segments
+        if (type(obj) is list and len(obj) == 5
+                and set(map(type, obj)) <= CONSTANT_TYPES
+                and type(obj[0]) is int and obj[0] >= 0
+                and math.isfinite(sum(obj))):
+            if obj[0] > self.max_material:
+                self.max_material = obj[0]
+                self.max_material_object = index
+            _, x, y, dx, dy = obj
+            self.add_bounds(min(x, x + dx), min(y, y + dy),
+                            max(x, x + dx), max(y, y + dy))
+            return
+
+        noun = 'object #%d' % index
+        if not isinstance(obj, list) or len(obj) not in (5, 7):
+            self.error("'%s' expected an array of 5 or 7 items" % noun)
+            return
+
+        material = obj[0]
+        if (not isinstance(material, int) or isinstance(material, bool)
+                or material < 0):
+            self.error('%s: material ID must be an unsigned integer' % noun)
+        elif material > self.max_material:
+            self.max_material = material
+            self.max_material_object = index
+
+        for i, value in enumerate(obj[1:], 1):
+            self.check_sampled(value, '%s [%d]' % (noun, i))
+
+        if len(obj) == 5:
+            x, y, dx, dy = obj[1:5]
+        else:
+            x, y, _, dx, dy, _ = obj[1:7]
+        x, y, dx, dy = (sample_bounds(value) for value in (x, y, dx, dy))
+        if None not in (x, y, dx, dy) and is_finite([x, y, dx, dy]):
+            self.add_bounds(min(x[0], x[0] + dx[0]), min(y[0], y[0] + dy[0]),
+                            max(x[1], x[1] + dx[1]), max(y[1], y[1] + dy[1]))
+
+    def check_material(self, material, index):
+        noun = 'material #%d' % index
+        if not isinstance(material, list):
+            self.error('%s is not an array' % noun)
+            return
+        for i, outcome in enumerate(material):
+            if (not isinstance(outcome, list) or not outcome
+                    or not is_number(outcome[0])):
+                self.error('%s outcome #%d is not an array starting with '
+                           'a number' % (noun, i))
+            elif self.check_finite(outcome, '%s outcome #%d' % (noun, i)):
+                if len(outcome) != 2 or outcome[1] not in ('d', 't', 'r'):
+                    self.warning('%s outcome #%d is unknown, hqz absorbs '
+                                 'the ray' % (noun, i))
+
+    def finish(self, members):
+        '''Check the scene as a whole, once all its members were read.'''
+        resolution = members.get('resolution')
+        if not isinstance(resolution, list) or len(resolution) < 2:
+            self.error("'resolution' expected an array with at least 2 items")
+        else:
+            for i in range(2):
+                if (self.check_integer(resolution[i], 'resolution[%d]' % i)
+                        and resolution[i] <= 0):
+                    self.error("'resolution[%d]' must be positive" % i)
+
+        viewport = members.get('viewport')
+        if not isinstance(viewport, list) or len(viewport) < 4:
+            self.error("'viewport' expected an array with at least 4 items")
+        else:
+            for i in range(4):
+                self.check_number(viewport[i], 'viewport[%d]' % i)
+
+        if 'exposure' not in members:
+            self.error("'exposure' is missing")
+        else:
+            self.check_number(members['exposure'], 'exposure')
+
+        limits = [members.get(key) for key in ('rays', 'timelimit')]
+        for key, limit in zip(('rays', 'timelimit'), limits):
+            if limit is not None:
+                self.check_number(limit, key)
+        if not any(is_number(limit) and limit > 0 for limit in limits):
+            self.error('No stopping conditions set. Expected a ray limit '
+                       'and/or time limit.')
+
+        for key in ('seed', 'debug'):
+            if members.get(key) is not None:
+                self.check_integer(members[key], key)
+        if members.get('gamma') is not None:
+            self.check_number(members['gamma'], 'gamma')
+
+        # Arrays were read item by item, and not kept
+        for key in ('lights', 'objects', 'materials'):
+            if key not in members or members[key] is not None:
+                self.error("'%s' expected an array" % key)
+        if not self.light_power > 0:
+            self.error('Total light power (%g) must be positive.'
+                       % self.light_power)
+
+        materials = self.materials or 0
+        if self.max_material >= materials:
+            self.error('object #%d: material ID (%d) out of range, %d '
+                       'materials' % (self.max_material_object,
+                                      self.max_material, materials))
+
+    def summary(self):
+        text = '%s: %d segments, %d lights, %d materials' % (
+            self.name, self.segments, self.lights, self.materials or 0)
+        if self.segments and self.bounds[0] <= self.bounds[2]:
+            text += ', bounds (%g, %g) to (%g, %g)' % tuple(self.bounds)
+        text += ', %s' % format_size(self.size)
+        if self.error_count:
+            text += ', %d errors' % self.error_count
+        if self.warning_count:
+            text += ', %d warnings' % self.warning_count
+        return text
+
+    def messages(self):
+        lines = ['  error: ' + message for message in self.errors]
+        if self.error_count > len(self.errors):
+            lines.append('  ... %d more errors'
+                         % (self.error_count - len(self.errors)))
+        lines += ['  warning: ' + message for message in self.warnings]
+        if self.warning_count > len(self.warnings):
+            lines.append('  ... %d more warnings'
+                         % (self.warning_count - len(self.warnings)))
+        return lines
+
+
+def format_size(size):
+    '''Format a number of bytes.'''
+    for unit in ('bytes', 'kB', 'MB'):
+        if size < 1000:
+            break
+        size /= 1000.0
+    else:
+        unit = 'GB'
+    return ('%d %s' if unit == 'bytes' else '%.1f %s') % (size, unit)
+
+
+def read_frame(reader, frame):
+    '''Read and check one scene from the reader.'''
+    start = reader.tell()
+    members = {}
+    checks = {'lights': frame.check_light,
+              'objects': frame.check_object,
+              'materials': frame.check_material}
+
+    for key in reader.members():
+        check = checks.get(key)
+        if check is None or reader.peek() != '[':
+            members[key] = reader.value()
+            continue
+
+        members[key] = None
+        count = 0
+        for item in reader.items():
+            check(item, count)
+            count += 1
+        if key == 'lights':
+            frame.lights = count
+        elif key == 'objects':
+            frame.segments = count
+        else:
+            frame.materials = count
+
+    frame.finish(members)
+    # Scenes are ASCII, so characters are bytes
+    frame.size = reader.tell() - start
+
+
+def validate_file(path):
+    '''Check all scenes in a file, returning a list of Frames.'''
+    frames = []
+    try:
+        # Keep line endings, for frame sizes
+        with open(path, newline='') as f:
+            reader = Reader(f)
+            while reader.peek():
+                name = path
+                if frames or not path.endswith('.json'):
+                    name = '%s:%d' % (path, len(frames) + 1)
+                frame = Frame(name)
+                frames.append(frame)
+                if reader.peek() != '{':
+                    raise reader.error('Expected a scene object')
+                read_frame(reader, frame)
+    except (OSError, UnicodeDecodeError, ParseError) as e:
+        if not frames:
+            frames.append(Frame(path))
+        frames[-1].error(str(e))
+    else:
+        if not frames:
+            frame = Frame(path)
+            frame.error('No scene in file')
+            frames.append(frame)
+    return frames
+
+
+def find_files(paths):
+    '''Expand directories into the scene files they contain.'''
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for directory, _, names in sorted(os.walk(path)):
+            files.extend(os.path.join(directory, name)
+                         for name in sorted(names)
+                         if name.endswith(EXTENSIONS) and name != MANIFEST)
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check hqz scene files and print frame statistics.')
+    parser.add_argument('paths', nargs='+',
+                        help='scene files, animations or directories')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(),
+                        help='number of files checked at once')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='only print frames with errors or warnings')
+    args = parser.parse_args()
+
+    files = find_files(args.paths)
+    if not files:
+        print('No scene files found')
+        return 1
+
+    frames = invalid = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for results in executor.map(validate_file, files):
+            for frame in results:
+                frames += 1
+                if frame.error_count:
+                    invalid += 1
+                if (args.quiet and not frame.error_count
+                        and not frame.warning_count):
+                    continue
+                print(frame.summary())
+                for line in frame.messages():
+                    print(line)
+
+    print('%d frames in %d files, %d with errors' % (frames, len(files),
+                                                     invalid))
+    return 1 if invalid else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
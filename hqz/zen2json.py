@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+#
+#   zen2json: Convert zenphoton.com scenes into JSON scenes for hqz, in
+#   batches.
+#
+#   This is a port of zen2json.coffee, which doesn't need Node. Input
+#   files hold zenphoton.com URLs, one per line. Each file is written as
+#   a scene of the same name with a .json extension, or as one scene per
+#   URL, numbered like exported frames, if it holds several. Files are
+#   converted in parallel. With -o, scenes keep the paths of their files
+#   relative to the directory holding all of them.
+#
+#   Scenes can be prepared for rendering at a higher quality: --scale
+#   multiplies the resolution without changing the viewport, and --rays
+#   sets the stopping condition, which zenphoton.com scenes don't have.
+#   Like the Blender exporter, scenes are indented unless --debug is
+#   used, which writes them on one line for wireframe.html. --precision
+#   rounds material probabilities and exposure.
+#
+#   usage: zen2json.py [-j WORKERS] [-o DIR] [--rays N] [--scale S]
+#                      urls.txt|directory ...
+#
+######################################################################
+#
+#   This file is part of HQZ, the batch renderer for Zen Photon Garden.
+#
+
+import argparse
+import base64
+import binascii
+import json
+import os
+import struct
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+
+ZEN_PREFIX = 'http://zenphoton.com/#'
+
+# Format version, width, height, light x and y, exposure, segments
+HEADER_V0 = struct.Struct('>BhhhhBH')
+
+# x0, y0, x1, y1, diffuse, reflective, transmissive
+SEGMENT_V0 = struct.Struct('>hhhhBBB')
+
+EXTENSIONS = ('.txt', '.url')
+
+
+def parse_zen_blob_v0(blob):
+    '''Parse a binary blob for zenphoton.com format version 0.'''
+    if len(blob) < HEADER_V0.size:
+        raise ValueError('Scene is truncated')
+    (_, width, height, light_x, light_y, exposure,
+     num_segments) = HEADER_V0.unpack_from(blob)
+    end = HEADER_V0.size + num_segments * SEGMENT_V0.size
+    if len(blob) < end:
+        raise ValueError('Scene is truncated, %d of %d segments'
+                         % ((len(blob) - HEADER_V0.size) // SEGMENT_V0.size,
+                            num_segments))
+
+    # One light, monochromatic white
+    light = [1, light_x, light_y, 0, 0, [0, 360], 0]
+
+    scene = {
+        'resolution': [width, height],
+        'viewport': [0, 0, width, height],
+        'exposure': exposure / 255.0,
+        'lights': [light],
+        'objects': [],
+        'materials': [],
+    }
+
+    # Materials are shared by segments with the same values
+    material_ids = {}
+    for (x0, y0, x1, y1, diffuse, reflective,
+         transmissive) in SEGMENT_V0.iter_unpack(blob[HEADER_V0.size:end]):
+        key = (diffuse, reflective, transmissive)
+        material_id = material_ids.get(key)
+        if material_id is None:
+            material = []
+            if diffuse > 0:
+                material.append([diffuse / 255.0, 'd'])
+            if reflective > 0:
+                material.append([reflective / 255.0, 'r'])
+            if transmissive > 0:
+                material.append([transmissive / 255.0, 't'])
+            material_id = material_ids[key] = len(scene['materials'])
+            scene['materials'].append(material)
+
+        scene['objects'].append([material_id, x0, y0, x1 - x0, y1 - y0])
+
+    return scene
+
+
+def parse_zen_blob(blob):
+    '''Parse a binary blob from zenphoton.com, with the decoder of its
+    format version, encoded in the first byte.'''
+    if not blob:
+        raise ValueError('Empty scene')
+    if blob[0] == 0x00:
+        return parse_zen_blob_v0(blob)
+    raise ValueError('Unknown scene format version %d' % blob[0])
+
+
+def parse_url(url):
+    '''Parse an entire zenphoton.com URL.'''
+    url = url.strip()
+    if not url.lower().startswith(ZEN_PREFIX):
+        raise ValueError('Not a zenphoton.com URL')
+    data = url[len(ZEN_PREFIX):]
+    # Like Node, accept URL-safe characters and missing padding
+    data = data.replace('-', '+').replace('_', '/')
+    data += '=' * (-len(data) % 4)
+    try:
+        blob = base64.b64decode(data)
+    except binascii.Error as e:
+        raise ValueError('Bad base64 data: %s' % e)
+    return parse_zen_blob(blob)
+
+
+def prepare(scene, scale=1.0, rays=None, precision=None):
+    '''Apply output options to a scene.'''
+    if scale != 1.0:
+        scene['resolution'] = [max(int(round(size * scale)), 1)
+                               for size in scene['resolution']]
+    if rays:
+        scene['rays'] = rays
+    if precision is not None:
+        scene['exposure'] = round(scene['exposure'], precision)
+        for material in scene['materials']:
+            for outcome in material:
+                outcome[0] = round(outcome[0], precision)
+    return scene
+
+
+def get_output_dirs(files, output_dir=None):
+    '''Get the directory to write the scenes of each input file to.
+
+    Under output_dir, files keep their paths relative to the deepest
+    directory holding all of them, so that files of the same name from
+    different directories don't overwrite each other.'''
+    if not output_dir:
+        return [os.path.dirname(path) for path in files]
+    dirs = [os.path.dirname(os.path.abspath(path)) for path in files]
+    root = os.path.commonpath(dirs)
+    return [os.path.normpath(os.path.join(output_dir,
+                                          os.path.relpath(d, root)))
+            for d in dirs]
+
+
+def get_output_paths(path, output_dir, count):
+    '''Get the paths of the scenes converted from an input file.'''
+    base = os.path.splitext(os.path.basename(path))[0]
+    base = os.path.join(output_dir or os.path.dirname(path), base)
+    if count == 1:
+        return [base + '.json']
+    return [base + '.' + str(i).zfill(4) + '.json' for i in range(count)]
+
+
+def convert_file(path, output_dir=None, debug=False, **options):
+    '''Convert the URLs of a file into scenes.
+
+    Returns the number of scenes and segments written, and an error
+    message for each URL which failed.'''
+    errors = []
+    try:
+        with open(path) as f:
+            urls = [(number, line) for number, line in enumerate(f, 1)
+                    if line.strip()]
+    except (OSError, UnicodeDecodeError) as e:
+        return 0, 0, ['%s: %s' % (path, e)]
+    if not urls:
+        return 0, 0, ['%s: No URL in file' % path]
+
+    scenes = segments = 0
+    if output_dir:
+        try:
+            os.makedirs(output_dir, exist_ok=True)
+        except OSError as e:
+            return 0, 0, ['%s: %s' % (path, e)]
+    paths = get_output_paths(path, output_dir, len(urls))
+    for (number, url), save_path in zip(urls, paths):
+        try:
+            scene = prepare(parse_url(url), **options)
+            with open(save_path, 'w') as f:
+                f.write(json.dumps(scene,
+                                   indent=None if debug else 2,
+                                   sort_keys=True))
+        except (OSError, ValueError) as e:
+            errors.append('%s:%d: %s' % (path, number, e))
+            continue
+        scenes += 1
+        segments += len(scene['objects'])
+    return scenes, segments, errors
+
+
+def find_files(paths):
+    '''Expand directories into the URL files they contain.'''
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for directory, _, names in sorted(os.walk(path)):
+            files.extend(os.path.join(directory, name)
+                         for name in sorted(names)
+                         if name.endswith(EXTENSIONS))
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Convert zenphoton.com URLs into hqz scenes.')
+    parser.add_argument('paths', nargs='+',
+                        help='files of URLs, one per line, or directories '
+                             'of .txt and .url files')
+    parser.add_argument('-o', '--output', metavar='DIR',
+                        help='directory to write scenes to, instead of '
+                             'next to their URL file')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(),
+                        help='number of files converted at once')
+    parser.add_argument('--rays', type=int,
+                        help='number of rays to render')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply the resolution')
+    parser.add_argument('--precision', type=int,
+                        help='number of decimals of material probabilities '
+                             'and exposure')
+    parser.add_argument('--debug', action='store_true',
+                        help='write scenes on one line, for wireframe.html')
+    args = parser.parse_args()
+
+    files = find_files(args.paths)
+    if not files:
+        print('No URL files found')
+        return 1
+
+    # Files of the same name but another extension would still write the
+    # same scenes
+    output_dirs = get_output_dirs(files, args.output)
+    owners = {}
+    for path, output_dir in zip(files, output_dirs):
+        base = get_output_paths(path, output_dir, 1)[0]
+        if base in owners:
+            sys.stderr.write('%s and %s would both write %s\n'
+                             % (owners[base], path, base))
+            return 1
+        owners[base] = path
+
+    start = time.time()
+    scenes = segments = failures = 0
+    convert = partial(convert_file, debug=args.debug,
+                      scale=args.scale, rays=args.rays,
+                      precision=args.precision)
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for file_scenes, file_segments, errors in executor.map(
+                convert, files, output_dirs, chunksize=16):
+            scenes += file_scenes
+            segments += file_segments
+            for error in errors:
+                sys.stderr.write(error + '\n')
+            failures += len(errors)
+
+    elapsed = max(time.time() - start, 1e-6)
+    print('Converted %d scenes, %d segments, from %d files in %.1f s: '
+          '%.0f scenes/s, %.0f segments/s'
+          % (scenes, segments, len(files), elapsed, scenes / elapsed,
+             segments / elapsed))
+    if failures:
+        print('%d scenes failed' % failures)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())